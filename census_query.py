@@ -3,10 +3,1261 @@
 # By Kenneth Burchfiel
 # Released under the MIT License
 
+import asyncio
+import contextvars
+import gzip
+import hashlib
+import http.client
+import json
+import logging
+import os
+import random
+import sqlite3
+import ssl
+import tempfile
+import threading
+import time
+import urllib.error
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO, StringIO
+from urllib.parse import urlsplit
+
+import numpy as np
 import pandas as pd
 
+try:
+    import orjson # Optional: parses Census API responses faster than the
+    # standard library's json module.
+except ImportError:
+    orjson = None
+
+try:
+    import pyarrow as pa # Optional: required by CensusResultStore
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+class _RateLimiter:
+    '''Spaces out request start times so that no more than
+    requests_per_second requests get sent to a single host. One limiter is
+    shared by all threads that query that host.'''
+
+    def __init__(self, requests_per_second):
+        self.requests_per_second = requests_per_second
+        self.interval = 1 / requests_per_second
+        self.lock = threading.Lock()
+        self.next_start = 0.0
+
+    def wait(self):
+        # Each caller reserves the next available start time while holding
+        # the lock, then sleeps (outside the lock) until that time arrives.
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+_rate_limiters = {} # Maps each host (e.g. 'api.census.gov') to its
+# _RateLimiter.
+_rate_limiters_lock = threading.Lock()
+
+
+def _get_rate_limiter(url, requests_per_second):
+    host = urlsplit(url).netloc
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(host)
+        if (limiter is None or 
+        limiter.requests_per_second != requests_per_second):
+            limiter = _RateLimiter(requests_per_second)
+            _rate_limiters[host] = limiter
+    return limiter
+
+
+def _remove_api_key(request_string):
+    '''Returns request_string without its 'key' parameter. Other query 
+    parameters are kept in their original order.'''
+    url_parts = urlsplit(request_string)
+    query = '&'.join(parameter for parameter in url_parts.query.split('&')
+    if not parameter.startswith('key='))
+    return url_parts._replace(query = query).geturl()
+
+
+def _write_atomically(path, contents):
+    '''Writes contents to a temporary file and then moves it to path, so
+    that other threads (or processes) never read a partially written 
+    file.'''
+    file_descriptor, temp_path = tempfile.mkstemp(
+        dir = os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(file_descriptor, 'w', encoding = 'utf-8') as f:
+        f.write(contents)
+    os.replace(temp_path, path)
+
+
+# Instrumentation
+# Each request and each processing stage within this module reports an
+# 'event' (a dictionary) once it finishes. Events contain the following
+# keys:
+# 'stage': 'request' (a Census API request), 'parse' (converting a 
+# response into a DataFrame), 'assemble' (combining batches), or 'numeric'
+# (converting results into numerical values).
+# 'seconds': the time that the stage took.
+# 'thread': the name of the thread in which the stage ran.
+# Depending on the stage, events may also include 'url' (without the API
+# key), 'bytes' (the size of a response), 'cached' (whether a response came
+# from the response cache), 'rows', and 'columns'.
+
+_instrumentation_sinks = [] # Functions that receive every event
+_instrumentation_collector = contextvars.ContextVar(
+    'census_query_instrumentation_collector', default = None) # A list that
+# receives events from the current call (see collect_instrumentation)
+
+
+def add_instrumentation_sink(sink):
+    '''Registers sink (a function that accepts one event dictionary) to
+    receive every event reported by this module, including events from
+    worker threads. Sinks should return quickly, since they are called
+    while requests are being processed.
+    log_instrumentation_event is a ready-made sink that writes events to 
+    the 'census_query' logger.'''
+    _instrumentation_sinks.append(sink)
+
+
+def remove_instrumentation_sink(sink):
+    '''Stops sending events to a sink added by add_instrumentation_sink.'''
+    _instrumentation_sinks.remove(sink)
+
+
+def log_instrumentation_event(event):
+    '''An instrumentation sink that logs each event (at the DEBUG level)
+    using the 'census_query' logger.'''
+    logging.getLogger('census_query').debug(
+        'census_query %s', json.dumps(event, default = str))
+
+
+class collect_instrumentation:
+    '''A context manager that collects the events reported within its
+    block (including those from worker threads started within it) into
+    a list. Concurrent blocks in other threads or asyncio tasks collect 
+    their own events separately.
+
+    Example:
+    with collect_instrumentation() as events:
+        df = retrieve_census_data(...)
+    df_summary = summarize_instrumentation(events)
+    '''
+
+    def __enter__(self):
+        self.events = []
+        self.token = _instrumentation_collector.set(self.events)
+        return self.events
+
+    def __exit__(self, *exc_info):
+        _instrumentation_collector.reset(self.token)
+
+
+def _record_span(stage, start_time, **fields):
+    '''Reports an event for a stage that began at start_time (a 
+    time.perf_counter() value).'''
+    collector = _instrumentation_collector.get()
+    if collector is None and not _instrumentation_sinks:
+        return # Nobody is listening, so the event doesn't need to be built.
+    event = {'stage':stage, 'seconds':time.perf_counter() - start_time,
+    'thread':threading.current_thread().name}
+    event.update(fields)
+    if collector is not None:
+        collector.append(event)
+    for sink in list(_instrumentation_sinks):
+        sink(event)
+
+
+def _submit_in_context(executor, function, *args):
+    '''Submits function to executor so that it runs within a copy of the
+    current context. This allows events from worker threads to reach the
+    collector (if any) of the call that started them.'''
+    return executor.submit(contextvars.copy_context().run, function, *args)
+
+
+def summarize_instrumentation(events):
+    '''Converts a list of events (see collect_instrumentation) into a
+    summary DataFrame with one row per stage. Its columns show how many
+    times each stage ran, the total and maximum time it took, and the 
+    total bytes, rows, and columns that it processed. (When several workers 
+    are used, stage times are summed across workers, so they can exceed
+    the call's overall runtime.)'''
+    df_events = pd.DataFrame(events, columns = 
+    ['stage', 'seconds', 'bytes', 'rows', 'columns', 'cached'])
+    df_events['cached'] = df_events['cached'].eq(True)
+    df_summary = df_events.groupby('stage', sort = False).agg(
+        count = ('seconds', 'size'), total_seconds = ('seconds', 'sum'),
+        max_seconds = ('seconds', 'max'), bytes = ('bytes', 'sum'), 
+        rows = ('rows', 'sum'), columns = ('columns', 'sum'),
+        cached = ('cached', 'sum'))
+    return df_summary
+
+
+def _run_with_summary(function, arguments):
+    '''Calls function with arguments (a dictionary of the arguments 
+    passed to one of this module's public functions, with return_summary 
+    set to True) while collecting its events. Returns the function's 
+    result along with a summary DataFrame (see summarize_instrumentation)
+    that also includes a 'total' row for the call as a whole.'''
+    arguments = dict(arguments, return_summary = False)
+    start_time = time.perf_counter()
+    with collect_instrumentation() as events:
+        result = function(**arguments)
+    total_seconds = time.perf_counter() - start_time
+    df_summary = summarize_instrumentation(events)
+    df_summary.loc['total'] = {'count':1, 'total_seconds':total_seconds,
+    'max_seconds':total_seconds, 'bytes':df_summary['bytes'].sum(),
+    'rows':0, 'columns':0, 'cached':df_summary['cached'].sum()}
+    return result, df_summary
+
+
+class OfflineCacheMissError(LookupError):
+    '''Raised when the response cache is in offline mode and does not
+    contain a response for the requested URL.'''
+
+
+class ResponseCache:
+    '''A content-addressed, on-disk store of raw Census API responses.
+
+    Each response body is saved under a SHA-256 hash of its request URL.
+    The 'key' parameter (i.e. the API key) gets removed from the URL before
+    it is hashed, so the same cached files can be used with any API key.
+
+    cache_dir: the folder in which responses will be stored. It will be
+    created if it doesn't already exist.
+
+    ttl_seconds: the number of seconds for which a cached response will be
+    considered valid. None (the default) means that responses never expire,
+    which works well for historical datasets (e.g. 2011 acs5 data) that
+    no longer change.
+
+    max_bytes: the maximum total size of all cached response bodies. Once
+    this size is exceeded, the least recently used responses will be
+    deleted. None means that no size limit will be applied.
+
+    offline: if True, responses will only be served from the cache; URLs
+    that aren't in the cache will raise an OfflineCacheMissError instead of
+    being retrieved from the Census website.
+    '''
+
+    def __init__(self, cache_dir, ttl_seconds = None, max_bytes = None, 
+    offline = False):
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok = True)
+
+    @staticmethod
+    def cache_key(request_string):
+        '''Returns the hash under which request_string's response will be
+        stored.'''
+        return hashlib.sha256(
+            _remove_api_key(request_string).encode('utf-8')).hexdigest()
+
+    def _paths(self, request_string):
+        key = self.cache_key(request_string)
+        return (os.path.join(self.cache_dir, key + '.body'), 
+        os.path.join(self.cache_dir, key + '.meta.json'))
+
+    def get(self, request_string):
+        '''Returns the cached body for request_string, or None if the
+        response isn't cached (or has expired).'''
+        body_path, meta_path = self._paths(request_string)
+        try:
+            with open(meta_path, encoding = 'utf-8') as meta_file:
+                meta = json.load(meta_file)
+            with open(body_path, encoding = 'utf-8') as body_file:
+                body = body_file.read()
+        except (OSError, ValueError):
+            return None
+        if (self.ttl_seconds is not None and 
+        time.time() - meta['stored_at'] > self.ttl_seconds):
+            return None
+        # The body file's modification time records when it was last used,
+        # which allows the least recently used files to be evicted first.
+        try:
+            os.utime(body_path)
+        except OSError:
+            pass
+        return body
+
+    def set(self, request_string, body):
+        '''Saves body as the response for request_string. Both files are
+        written atomically, so other threads (or processes) never read a 
+        partially written response.'''
+        body_path, meta_path = self._paths(request_string)
+        meta = {'url': _remove_api_key(request_string), 
+        'stored_at': time.time()}
+        _write_atomically(body_path, body)
+        _write_atomically(meta_path, json.dumps(meta))
+        if self.max_bytes is not None:
+            self.evict()
+
+    def evict(self):
+        '''Deletes the least recently used responses until the cache's total
+        size no longer exceeds max_bytes.'''
+        with self.lock:
+            body_files = []
+            for file_name in os.listdir(self.cache_dir):
+                if file_name.endswith('.body'):
+                    path = os.path.join(self.cache_dir, file_name)
+                    try:
+                        stats = os.stat(path)
+                    except OSError:
+                        continue
+                    body_files.append((stats.st_mtime, stats.st_size, path))
+            total_bytes = sum(size for _, size, _ in body_files)
+            for _, size, path in sorted(body_files):
+                if total_bytes <= self.max_bytes:
+                    break
+                for stale_path in (path, path[:-len('.body')] + '.meta.json'):
+                    try:
+                        os.remove(stale_path)
+                    except OSError:
+                        pass
+                total_bytes -= size
+
+    def clear(self):
+        '''Deletes all cached responses.'''
+        with self.lock:
+            for file_name in os.listdir(self.cache_dir):
+                if file_name.endswith(('.body', '.meta.json')):
+                    os.remove(os.path.join(self.cache_dir, file_name))
+
+
+_response_cache = None # Stores the ResponseCache (if any) that all
+# functions in this module use.
+
+
+def enable_response_cache(cache_dir, ttl_seconds = None, max_bytes = None,
+offline = False):
+    '''Stores all subsequent Census API responses in cache_dir, and serves
+    repeat requests from that folder instead of the Census website. 
+    See ResponseCache for documentation on each argument.
+    Returns the ResponseCache object.'''
+    global _response_cache
+    _response_cache = ResponseCache(cache_dir, ttl_seconds = ttl_seconds,
+    max_bytes = max_bytes, offline = offline)
+    return _response_cache
+
+
+def disable_response_cache():
+    '''Stops using the response cache. (Cached files are not deleted.)'''
+    global _response_cache
+    _response_cache = None
+
+
+_census_api_root = 'https://api.census.gov' # The scheme and host used
+# within every URL that this module creates
+
+
+class CensusHTTPClient:
+    '''A thread-safe HTTP client that all requests in this module are
+    routed through. Compared to passing URLs directly to pd.read_json, it:
+
+    1. Reuses connections (and thus TLS sessions) across requests by 
+    keeping up to pool_size idle keep-alive connections per host;
+    2. Applies a timeout (in seconds) to each request;
+    3. Retries requests that fail because of connection problems or
+    429/5xx responses up to max_retries times. The delay before each retry 
+    grows exponentially (backoff_factor * 2**attempt seconds, capped at 
+    max_backoff) and is randomized ('jittered') so that parallel workers
+    don't all retry at once. A Retry-After header, if present, sets the
+    minimum delay.
+    4. Requests gzip-compressed responses, which greatly reduces the size
+    of large Census API downloads.
+
+    base_url: an optional scheme and host (e.g. 'http://127.0.0.1:8000')
+    that will replace https://api.census.gov within each URL. This allows 
+    the module to be tested against a local stand-in for the Census API.
+
+    Error responses that aren't retried (or that are still failing after
+    max_retries retries) raise a urllib.error.HTTPError, just as 
+    pd.read_json does. The error's read() method returns the response 
+    body, which contains the API's explanation of the error.
+
+    Servers close keep-alive connections that have been idle for too long.
+    If an idle connection turns out to have been closed before any part of
+    its response arrived, the request is immediately sent again over a new
+    connection (without counting as a retry), and the host's other idle
+    connections are discarded, since they have most likely been closed as
+    well.
+    '''
+
+    retry_statuses = {429, 500, 502, 503, 504}
+
+    def __init__(self, timeout = 60, max_retries = 4, backoff_factor = 0.5,
+    max_backoff = 30, pool_size = 16, base_url = None):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.pool_size = pool_size
+        self.base_url = base_url
+        self.idle_connections = {} # Maps (scheme, host) tuples to lists of
+        # idle connections
+        self.lock = threading.Lock()
+
+    def _acquire(self, scheme, host):
+        '''Returns an idle connection to host (or a new one if none are
+        available), along with whether the connection is being reused.'''
+        with self.lock:
+            idle = self.idle_connections.get((scheme, host))
+            if idle:
+                return idle.pop(), True
+        if scheme == 'https':
+            return http.client.HTTPSConnection(
+                host, timeout = self.timeout), False
+        return http.client.HTTPConnection(host, timeout = self.timeout), False
+
+    def _discard_idle(self, scheme, host):
+        '''Closes all idle connections to host.'''
+        with self.lock:
+            idle = self.idle_connections.pop((scheme, host), [])
+        for connection in idle:
+            connection.close()
+
+    def _release(self, scheme, host, connection):
+        with self.lock:
+            idle = self.idle_connections.setdefault((scheme, host), [])
+            if len(idle) < self.pool_size:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        '''Closes all idle connections.'''
+        with self.lock:
+            for idle in self.idle_connections.values():
+                for connection in idle:
+                    connection.close()
+            self.idle_connections = {}
+
+    def _retry_delay(self, attempt, retry_after = None):
+        delay = random.uniform(0, min(self.max_backoff, 
+        self.backoff_factor * 2 ** attempt))
+        if retry_after is not None and retry_after.strip().isdigit():
+            delay = max(delay, min(self.max_backoff, int(retry_after)))
+        return delay
+
+    def get_bytes(self, request_string):
+        '''Retrieves request_string and returns the (decompressed) response
+        body along with the response's headers.'''
+        if self.base_url is not None and request_string.startswith(
+            _census_api_root):
+            request_string = self.base_url.rstrip('/') + request_string[
+                len(_census_api_root):]
+        url_parts = urlsplit(request_string)
+        path = url_parts.path + ('?' + url_parts.query 
+        if url_parts.query else '')
+        headers = {'Accept-Encoding':'gzip', 'User-Agent':'census_query'}
+
+        attempt = 0
+        while True:
+            connection, reused = self._acquire(
+                url_parts.scheme, url_parts.netloc)
+            response = None
+            try:
+                connection.request('GET', path, headers = headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (OSError, http.client.HTTPException) as error:
+                connection.close()
+                if reused and response is None and isinstance(
+                    error, ConnectionError):
+                    # The server closed this idle connection before the
+                    # request was sent (see above).
+                    self._discard_idle(url_parts.scheme, url_parts.netloc)
+                    continue
+                # Connection errors and timeouts are retried using a new
+                # connection.
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self._retry_delay(attempt))
+                attempt += 1
+                continue
+
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(url_parts.scheme, url_parts.netloc, connection)
+
+            if response.status in self.retry_statuses and (
+                attempt < self.max_retries):
+                time.sleep(self._retry_delay(
+                    attempt, response.getheader('Retry-After')))
+                attempt += 1
+                continue
+            if response.getheader('Content-Encoding', '').lower() == 'gzip':
+                body = gzip.decompress(body)
+            if response.status >= 400:
+                raise urllib.error.HTTPError(request_string.split('&key=')[0],
+                response.status, response.reason, response.headers, 
+                BytesIO(body))
+            return body, response.headers
+
+    def get_text(self, request_string):
+        '''Retrieves request_string and returns the response body as a
+        string.'''
+        body, headers = self.get_bytes(request_string)
+        return body.decode(headers.get_content_charset() or 'utf-8')
+
+
+_http_client = CensusHTTPClient() # The client that all functions in this
+# module share
+
+
+def configure_http_client(**kwargs):
+    '''Replaces the shared HTTP client with a new CensusHTTPClient created
+    using the provided keyword arguments (e.g. timeout = 120 or 
+    base_url = 'http://127.0.0.1:8000'). See CensusHTTPClient for 
+    documentation on each argument. Returns the new client.'''
+    global _http_client
+    _http_client.close()
+    _http_client = CensusHTTPClient(**kwargs)
+    return _http_client
+
+
+def _get_response_text(request_string):
+    '''Returns the raw body of the response to request_string, using the
+    response cache if one has been enabled.'''
+    start_time = time.perf_counter()
+    body = _read_cached_response(request_string, start_time)
+    if body is not None:
+        return body
+    body = _http_client.get_text(request_string)
+    _save_response(request_string, body, start_time)
+    return body
+
+
+def _read_cached_response(request_string, start_time):
+    '''Returns the cached body of the response to request_string, or None
+    if the response cache is disabled or doesn't contain it. (In offline
+    mode, an OfflineCacheMissError is raised instead of returning None.)'''
+    cache = _response_cache
+    if cache is None:
+        return None
+    body = cache.get(request_string)
+    if body is not None:
+        _record_span('request', start_time, 
+        url = _remove_api_key(request_string), bytes = len(body), 
+        cached = True)
+        return body
+    if cache.offline:
+        raise OfflineCacheMissError(
+            "No cached response is available for: "+
+            request_string.split('&key=')[0])
+    return None
+
+
+def _save_response(request_string, body, start_time):
+    '''Stores a newly retrieved response body in the response cache (if
+    one has been enabled) and records the request.'''
+    # Only successful responses reach this point (the HTTP clients raise 
+    # an HTTPError for error responses), so errors never get cached.
+    cache = _response_cache
+    if cache is not None:
+        cache.set(request_string, body)
+    _record_span('request', start_time, url = _remove_api_key(request_string),
+    bytes = len(body), cached = False)
+
+
+def _parse_census_json(response_text):
+    '''Converts the body of a Census API response into a DataFrame, using
+    its first row (which stores column names) as the header. 
+    (The API returns an empty response when no regions match a request;
+    in that case, an empty DataFrame is returned.)
+
+    The response (a JSON array of arrays) is parsed with orjson if it is 
+    installed and the json module otherwise. Each column is then built 
+    from a single array of the parsed rows: the 'NAME', 'GEO_ID', and 
+    geography columns are kept as strings, and all other columns are 
+    converted to float64 values in a single NumPy call. (Columns that 
+    contain non-numerical values, such as annotation codes, are kept as
+    strings.) This avoids the intermediate all-object DataFrames that
+    pd.read_json would create.
+    '''
+    start_time = time.perf_counter()
+    if not response_text.strip():
+        return pd.DataFrame()
+    if orjson is not None:
+        rows = orjson.loads(response_text)
+    else:
+        rows = json.loads(response_text)
+    header = rows[0]
+    # All rows are placed in a single two-dimensional array so that the 
+    # numerical columns can then be converted together.
+    values = np.array(rows[1:], dtype = object).reshape(-1, len(header))
+    numeric_positions = [i for i, name in enumerate(header) if name not in 
+    ['NAME', 'GEO_ID'] + _geography_id_columns]
+    try:
+        numeric_values = values[:, numeric_positions].astype('float64')
+        numeric_columns = dict(zip(numeric_positions, numeric_values.T))
+    except (TypeError, ValueError):
+        # At least one column contains non-numerical values, so the columns
+        # are converted one at a time instead.
+        numeric_columns = {}
+        for i in numeric_positions:
+            try:
+                numeric_columns[i] = values[:, i].astype('float64')
+            except (TypeError, ValueError):
+                numeric_columns[i] = values[:, i]
+
+    column_data = {i:numeric_columns.get(i, values[:, i]) 
+    for i in range(len(header))}
+    # The columns are initially keyed by position so that duplicate names
+    # (e.g. a variable that was requested twice) are preserved.
+    # The index starts at 1, as it did when the header row was read in as
+    # the DataFrame's first row and then dropped.
+    df_response = pd.DataFrame(column_data, 
+    index = pd.RangeIndex(1, len(values) + 1))
+    df_response.columns = header
+    _record_span('parse', start_time, rows = len(df_response), 
+    columns = len(df_response.columns))
+    return df_response
+
+
+def _read_census_json(request_string):
+    '''Retrieves a Census API response and converts it into a DataFrame
+    (see _parse_census_json).'''
+    return _parse_census_json(_get_response_text(request_string))
+
+
+class _Checkpoint:
+    '''Saves each response retrieved during a long-running function call
+    within checkpoint_dir so that, if the call fails partway through, 
+    re-running it with the same arguments will only retrieve the responses
+    that are still missing.
+
+    The folder contains one file per completed response along with a
+    manifest (manifest.json) that lists every URL in the run (without
+    the API key) and the file in which each completed response is stored.
+    All files are written atomically, so an interrupted run never leaves
+    behind a partially written response.
+    '''
+
+    def __init__(self, checkpoint_dir, request_strings):
+        self.checkpoint_dir = checkpoint_dir
+        self.manifest_path = os.path.join(checkpoint_dir, 'manifest.json')
+        self.lock = threading.Lock()
+        os.makedirs(checkpoint_dir, exist_ok = True)
+        keyless_urls = [_remove_api_key(request_string) 
+        for request_string in request_strings]
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, encoding = 'utf-8') as f:
+                self.manifest = json.load(f)
+            if self.manifest['urls'] != keyless_urls:
+                raise ValueError("The checkpoint folder "+checkpoint_dir+
+                " was created for a different request. Use a new folder "
+                "(or delete this one) to start a new run.")
+            print("Resuming from checkpoint:",len(self.manifest['completed']),
+            "of",len(keyless_urls),"responses already retrieved.")
+        else:
+            self.manifest = {'urls':keyless_urls, 'completed':{}}
+            _write_atomically(self.manifest_path, json.dumps(self.manifest))
+
+    def load(self, request_string):
+        '''Returns the saved response for request_string, or None if it
+        hasn't been retrieved yet.'''
+        file_name = self.manifest['completed'].get(
+            _remove_api_key(request_string))
+        if file_name is None:
+            return None
+        with open(os.path.join(self.checkpoint_dir, file_name), 
+        encoding = 'utf-8') as f:
+            return f.read()
+
+    def save(self, request_string, response_text):
+        '''Saves response_text, then records it within the manifest.'''
+        file_name = ResponseCache.cache_key(request_string) + '.json'
+        _write_atomically(os.path.join(self.checkpoint_dir, file_name), 
+        response_text)
+        with self.lock:
+            self.manifest['completed'][
+                _remove_api_key(request_string)] = file_name
+            _write_atomically(self.manifest_path, json.dumps(self.manifest))
+
+
+def _fetch_census_batch(request_string, requests_per_second = None,
+checkpoint = None):
+    '''Retrieves a single Census API response (waiting first, if necessary,
+    so that requests_per_second is not exceeded). If a _Checkpoint is 
+    provided, previously saved responses will be loaded from it instead,
+    and newly retrieved responses will be saved to it.'''
+    if checkpoint is not None:
+        response_text = checkpoint.load(request_string)
+        if response_text is not None:
+            return _parse_census_json(response_text)
+    if requests_per_second is not None:
+        _get_rate_limiter(request_string, requests_per_second).wait()
+    response_text = _get_response_text(request_string)
+    if checkpoint is not None:
+        checkpoint.save(request_string, response_text)
+    return _parse_census_json(response_text)
+
+
+def _iter_census_batches(request_strings, max_workers = 1, 
+requests_per_second = None, checkpoint = None):
+    '''Retrieves each URL in request_strings and yields the resulting
+    DataFrames in the same order as the URLs.
+
+    max_workers: the maximum number of requests that can be in flight at
+    once. If max_workers is 1, the requests will be made one after another.
+    No more than max_workers responses are held in memory at any time.
+
+    requests_per_second: an optional cap on the rate at which requests are
+    sent to each host. None means that no cap will be applied.
+
+    checkpoint: an optional _Checkpoint in which responses will be saved
+    (and from which previously saved responses will be loaded).
+    '''
+
+    if max_workers <= 1:
+        for request_string in request_strings:
+            yield _fetch_census_batch(
+                request_string, requests_per_second, checkpoint)
+        return
+
+    # Futures are yielded in the order in which their URLs were submitted 
+    # (rather than the order in which they finished), so the batches can be
+    # combined in their original variable order. A new request is submitted
+    # each time a batch is yielded, which keeps max_workers requests in 
+    # flight without letting completed batches pile up.
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        pending = deque()
+        for request_string in request_strings:
+            pending.append(_submit_in_context(executor, _fetch_census_batch,
+            request_string, requests_per_second, checkpoint))
+            if len(pending) >= max_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _fetch_census_batches(request_strings, max_workers = 1, 
+requests_per_second = None, checkpoint_dir = None):
+    '''Returns a list of the DataFrames yielded by _iter_census_batches.
+    If checkpoint_dir is provided, the responses will be checkpointed
+    within that folder (see _Checkpoint).'''
+    checkpoint = None if checkpoint_dir is None else _Checkpoint(
+        checkpoint_dir, request_strings)
+    return list(_iter_census_batches(request_strings, 
+    max_workers = max_workers, requests_per_second = requests_per_second,
+    checkpoint = checkpoint))
+
+
+def _iter_sharded_batches(request_strings, max_workers = 1, 
+requests_per_second = None, checkpoint_dir = None, batch_messages = None):
+    '''Retrieves a nested list of URLs (such as the one returned by 
+    _build_batch_request_strings) in which each inner list stores the
+    shards of a single batch. All shards are retrieved by the same pool of
+    workers; the shards for each batch are then stacked into a single 
+    DataFrame, which is yielded in the original batch order.
+    If checkpoint_dir is provided, the responses will be checkpointed
+    within that folder (see _Checkpoint).
+
+    batch_messages: an optional list of progress messages (see 
+    _get_batch_messages), one of which is printed as each batch is 
+    retrieved.'''
+    flat_request_strings = [request_string for shards in request_strings 
+    for request_string in shards]
+    checkpoint = None if checkpoint_dir is None else _Checkpoint(
+        checkpoint_dir, flat_request_strings)
+    responses = _iter_census_batches(flat_request_strings, 
+    max_workers = max_workers, requests_per_second = requests_per_second,
+    checkpoint = checkpoint)
+    for batch_number, shards in enumerate(request_strings):
+        if batch_messages is not None:
+            print(batch_messages[batch_number])
+        yield _stack_shards([next(responses) for _ in shards])
+
+
+def _stack_shards(shard_frames):
+    '''Stacks the DataFrames retrieved for each shard of a batch into a 
+    single DataFrame.'''
+    # Shards without any data (e.g. a state that isn't covered by a
+    # dataset) are returned as empty DataFrames and can be skipped.
+    shard_frames = [frame for frame in shard_frames 
+    if len(frame.columns) > 0] or shard_frames[:1]
+    if len(shard_frames) == 1:
+        return shard_frames[0]
+    return pd.concat(shard_frames, ignore_index = True)
+
+
+def _fetch_sharded_batches(request_strings, max_workers = 1, 
+requests_per_second = None, checkpoint_dir = None, batch_messages = None):
+    '''Returns a list of the DataFrames yielded by _iter_sharded_batches.'''
+    return list(_iter_sharded_batches(request_strings, 
+    max_workers = max_workers, requests_per_second = requests_per_second,
+    checkpoint_dir = checkpoint_dir, batch_messages = batch_messages))
+
+
+def _get_source_string(source):
+    '''Converts a 'source' value into the corresponding folder of the 
+    Census API. The following sources are supported:
+
+    'acs5': American Community Survey (5-year estimates)
+    'acs1': American Community Survey (1-year estimates)
+    'census_redistricting': US Decennial Census redistricting data
+    'census_sf1': US Decennial Census summary file data
+    '''
+    
+    # Note: At the time of writing this function, 2020 US Census data was not
+    # yet fully available. Once it becomes available, I plan to add a new
+    # 'source' option that covers that data, as I don't believe it will exist
+    # under the /sf1 folder anymore.
+
+    source_strings = {'acs5':'/acs/acs5', 'acs1':'/acs/acs1',
+    'census_redistricting':'/dec/pl', 'census_sf1':'/dec/sf1'}
+    if source not in source_strings:
+        raise ValueError("Unrecognized source: "+str(source)+
+        ". Options are: "+', '.join(source_strings))
+    return source_strings[source]
+
+
+def _get_region_string(region, state = None):
+    '''Converts a 'region' value ('zip', 'state', 'county', 'tract', or
+    'block group') into the geography clause of a Census API URL.
+
+    state: an optional state FIPS code (e.g. '01' or 1 for Alabama) that
+    limits the results to a single state. Tracts and block groups can only
+    be requested one state at a time, so a state must be provided for those
+    regions. (Zip code tabulation areas can't be filtered by state.)
+    '''
+    region_strings = {'zip':'&for=zip%20code%20tabulation%20area:*',
+    'state':'&for=state:*', 'county':'&for=county:*&in=state:*',
+    'tract':None, 'block group':None}
+    if region not in region_strings:
+        raise ValueError("Unrecognized region: "+str(region)+
+        ". Options are: "+', '.join(region_strings))
+    if state is None:
+        if region_strings[region] is None:
+            raise ValueError("A state must be specified in order to "
+            "retrieve "+region+" data.")
+        return region_strings[region]
+
+    state = str(state).zfill(2)
+    if region == 'zip':
+        raise ValueError("Zip code tabulation areas can't be filtered by "
+        "state.")
+    if region == 'state':
+        return '&for=state:'+state
+    if region == 'block group':
+        # Block groups also need to be nested within counties; a wildcard
+        # retrieves the block groups within every county in the state.
+        return '&for=block%20group:*&in=state:'+state+'%20county:*'
+    return '&for='+region+':*&in=state:'+state
+
+
+def _get_state_codes(year, source_string, api_key):
+    '''Returns a sorted list of the state FIPS codes for which data is 
+    available in a given year and source.'''
+    df_states = _read_census_json('https://api.census.gov/data/'+str(year)+
+    source_string+'?get=NAME&for=state:*&key='+api_key)
+    return sorted(df_states['state'])
+
+
+def _get_region_strings(region, states, year, source_string, api_key):
+    '''Returns a list of geography clauses that, together, cover the
+    requested region. Each clause represents a separate 'shard' of the
+    region that will be requested on its own.
+
+    states: None (in which case a single clause covering the entire 
+    country will be returned), a list of state FIPS codes (in which case 
+    one clause per state will be returned), or 'all' (in which case one
+    clause will be returned for every state with data). Tracts and block
+    groups are always split by state, so they default to 'all'.
+    '''
+    if states is None:
+        if region in ('tract', 'block group'):
+            states = 'all'
+        else:
+            return [_get_region_string(region)]
+    if isinstance(states, str) and states == 'all':
+        states = _get_state_codes(year, source_string, api_key)
+    elif isinstance(states, (str, int)): # A single state code
+        states = [states]
+    return [_get_region_string(region, state) for state in states]
+
+
+_geography_id_columns = ['state', 'county', 'tract', 'block group',
+'zip code tabulation area']
+# The geography columns that the Census API appends to each response (in
+# the order in which they appear). Together, the columns present in a 
+# response uniquely identify each of its rows.
+
+
+_geography_code_widths = {'state':2, 'county':3, 'tract':6, 'block group':1,
+'zip code tabulation area':5, 'NAME':5}
+# The number of digits in each geography code. A region's GEOID consists of
+# its codes written one after another (e.g. '01001' for Autauga County, 
+# Alabama: state '01' followed by county '001'). ('NAME' is included for 
+# zip code results, in which it stores the zip code.)
+
+_region_geoid_widths = {'state':2, 'county':5, 'tract':11, 
+'block group':12, 'zip':5}
+
+_state_abbreviations = {'01':'AL', '02':'AK', '04':'AZ', '05':'AR', 
+'06':'CA', '08':'CO', '09':'CT', '10':'DE', '11':'DC', '12':'FL', '13':'GA',
+'15':'HI', '16':'ID', '17':'IL', '18':'IN', '19':'IA', '20':'KS', '21':'KY',
+'22':'LA', '23':'ME', '24':'MD', '25':'MA', '26':'MI', '27':'MN', '28':'MS',
+'29':'MO', '30':'MT', '31':'NE', '32':'NV', '33':'NH', '34':'NJ', '35':'NM',
+'36':'NY', '37':'NC', '38':'ND', '39':'OH', '40':'OK', '41':'OR', '42':'PA',
+'44':'RI', '45':'SC', '46':'SD', '47':'TN', '48':'TX', '49':'UT', '50':'VT',
+'51':'VA', '53':'WA', '54':'WV', '55':'WI', '56':'WY', '60':'AS', '66':'GU',
+'69':'MP', '72':'PR', '78':'VI'}
+# USPS abbreviations for each state FIPS code (the API doesn't provide 
+# these)
+
+
+def _get_geoid_columns(df, region = None):
+    '''Returns the columns of df from which its GEOIDs can be built (see
+    compute_geoids).'''
+    if 'zip code tabulation area' in df.columns:
+        # A zip code's GEOID is its zip code, even within older responses
+        # that also contain a 'state' column.
+        return ['zip code tabulation area']
+    if region == 'zip':
+        return ['NAME']
+    id_columns = [column for column in _geography_id_columns 
+    if column in df.columns]
+    if len(id_columns) == 0:
+        id_columns = ['NAME']
+    return id_columns
+
+
+def compute_geoids(df, region = None):
+    '''Returns a Series containing each row's GEOID (the Census Bureau's
+    canonical geography identifier) as a 64-bit integer. These integers
+    take up far less memory than region names and can be compared much 
+    more quickly, making them well suited for joining results across 
+    years and sources. Unlike names (several states have counties with the
+    same name), GEOIDs are unique.
+
+    The GEOIDs are built from df's 'state', 'county', 'tract', 'block
+    group', and 'zip code tabulation area' columns, which can store either
+    strings (as returned by the API) or numbers (as in the output of 
+    retrieve_census_data). (If a 'zip code tabulation area' column is 
+    present, it is used on its own, as older zip code responses also 
+    contain a 'state' column.) If none of these columns are present, df's
+    'NAME' column is assumed to store zip codes (as it does in zip code 
+    results).
+
+    region: if 'zip', df's 'NAME' column will be used even if df has a 
+    'state' column (as zip code results from 2016 and earlier do).
+
+    Because leading zeros are dropped, use format_geoids to convert these
+    integers back into the Census Bureau's zero-padded strings.
+    '''
+    geoids = np.zeros(len(df), dtype = 'int64')
+    for column in _get_geoid_columns(df, region):
+        codes = df[column]
+        if codes.isna().any():
+            raise ValueError('GEOIDs can\'t be computed because the \''+
+            column+'\' column contains missing values.')
+        if column == 'NAME':
+            codes = codes.astype(str).str.replace('ZCTA5 ','')
+        # Converting the codes within NumPy is much faster than calling
+        # pd.to_numeric(), which is only used for codes that NumPy can't
+        # convert (such as '1.0' in older .csv files).
+        try:
+            codes = np.asarray(codes.to_numpy()).astype('int64')
+        except (TypeError, ValueError):
+            codes = pd.to_numeric(codes).to_numpy(dtype = 'int64')
+        geoids = geoids * 10**_geography_code_widths[column] + codes
+    return pd.Series(geoids, index = df.index, name = 'GEOID')
+
+
+def format_geoids(geoids, region):
+    '''Converts integer GEOIDs (see compute_geoids) for a given region
+    ('zip', 'state', 'county', 'tract', or 'block group') into zero-padded
+    strings, e.g. 1001 into '01001' for counties.'''
+    return pd.Series(geoids, name = 'GEOID').astype(str).str.zfill(
+        _region_geoid_widths[region])
+
+
+def set_geoid_index(df, as_category = False, region = None):
+    '''Returns a copy of df (e.g. the output of retrieve_census_data or
+    compare_variable_across_years) that is indexed by each row's GEOID.
+    DataFrames indexed this way can be joined on their GEOIDs using 
+    pd.concat([df_1, df_2], axis = 1) or df_1.join(df_2).
+
+    as_category: if False (the default), the GEOIDs will be stored as 
+    64-bit integers (see compute_geoids). If True, they will instead be
+    stored as a categorical column of zero-padded strings, which retains
+    the Census Bureau's formatting while still using little memory.
+
+    region: see compute_geoids.
+    '''
+    geoids = compute_geoids(df, region)
+    if as_category:
+        width = sum(_geography_code_widths[column] 
+        for column in _get_geoid_columns(df, region))
+        geoids = geoids.astype(str).str.zfill(width).astype('category')
+    return df.set_index(geoids)
+
+
+def build_geography_index(year, source, region, api_key, states = None,
+max_workers = 1, requests_per_second = None):
+    '''This function retrieves the name and geography codes of every 
+    region of a given type ('zip', 'state', 'county', 'tract', or 'block 
+    group') and returns them as a lookup table indexed by integer GEOID
+    (see compute_geoids). Only the API's geography columns are requested, 
+    so the table can be built quickly and then reused to label or filter
+    results that were stored by GEOID.
+
+    Besides 'NAME' and the region's code columns (stored as zero-padded
+    strings), the table contains a 'GEOID_string' column with each 
+    region's zero-padded GEOID. If the region has a 'state' column, the 
+    table also contains 'state_name' and 'state_abbreviation' columns 
+    (e.g. 'Alabama' and 'AL').
+
+    states, max_workers, and requests_per_second work the same way as in
+    retrieve_census_data.
+    '''
+    source_string = _get_source_string(source)
+    region_strings = _get_region_strings(
+        region, states, year, source_string, api_key)
+    request_strings = [['https://api.census.gov/data/'+str(year)+
+    source_string+'?get=NAME'+region_string+'&key='+api_key 
+    for region_string in region_strings]]
+    df_geographies = _concat_on_geography(_fetch_sharded_batches(
+        request_strings, max_workers = max_workers, 
+        requests_per_second = requests_per_second))
+    if region == 'zip':
+        df_geographies['NAME'] = df_geographies['NAME'].str.replace(
+            'ZCTA5 ','').str.zfill(5)
 
-def generate_variable_and_group_lists(year, source, variable_filter):
+    df_geographies = set_geoid_index(df_geographies, region = region)
+    df_geographies['GEOID_string'] = format_geoids(
+        df_geographies.index, region).to_numpy()
+    if 'state' in df_geographies.columns:
+        # State names are retrieved in a separate request, as the names of
+        # smaller regions don't always end with their state's name.
+        df_states = _read_census_json('https://api.census.gov/data/'+
+        str(year)+source_string+'?get=NAME&for=state:*&key='+api_key)
+        df_geographies['state_name'] = df_geographies['state'].map(
+            df_states.set_index('state')['NAME'])
+        df_geographies['state_abbreviation'] = df_geographies['state'].map(
+            _state_abbreviations)
+    return df_geographies
+
+
+def find_geographies(df_geography_index, name, state = None):
+    '''Returns the rows of df_geography_index (see build_geography_index)
+    whose names contain name (ignoring case). 
+
+    state: an optional state abbreviation (e.g. 'AL'), name (e.g. 
+    'Alabama'), or FIPS code (e.g. '01') to which the results will be
+    limited. This is helpful for names that appear in multiple states,
+    such as 'Washington County'.
+    '''
+    matches = df_geography_index['NAME'].str.contains(
+        name, case = False, regex = False)
+    if state is not None:
+        state = str(state)
+        if state.isdigit():
+            matches &= df_geography_index['state'] == state.zfill(2)
+        elif len(state) == 2:
+            matches &= df_geography_index['state_abbreviation'] == \
+                state.upper()
+        else:
+            matches &= df_geography_index['state_name'].str.lower() == \
+                state.lower()
+    return df_geography_index[matches]
+
+
+def _concat_on_geography(batches, column_names = None):
+    '''Combines DataFrames returned by the Census API (each of which
+    contains a 'NAME' column, one or more data columns, and geography
+    identifier columns) into a single DataFrame.
+
+    Each batch is indexed by its integer GEOIDs (see compute_geoids) so 
+    that the batches can be aligned in one pd.concat() call. The result 
+    contains a 'NAME' column followed by the 'state', 'county', 'tract', 
+    and 'block group' columns (if present) and then each batch's data 
+    columns in their original order.
+    Rows are sorted by 'NAME'. (The zip code column is dropped, since that 
+    information is already present in the 'NAME' column.)
+
+    column_names: optional names for the data columns. If provided, there
+    must be one name for each data column.
+    '''
+    start_time = time.perf_counter()
+    # Batches don't always share the same geography columns: for instance,
+    # zip code responses from 2016 and earlier contain a 'state' column,
+    # but later ones don't. (Zip code batches are therefore keyed by their
+    # zip code alone; see _get_geoid_columns.)
+    id_columns = [column for column in _geography_id_columns 
+    if any(column in batch.columns for batch in batches)]
+    indexed_batches = [batch.set_index(compute_geoids(batch)) 
+    for batch in batches]
+    batch_id_columns = [[column for column in id_columns 
+    if column in batch.columns] for batch in batches]
+
+    # Regions missing from the first batch would otherwise have no name or
+    # geography codes, so these columns are combined from every batch 
+    # (keeping the first value found for each region and column).
+    df_labels = pd.concat([batch[['NAME'] + columns] for batch, columns 
+    in zip(indexed_batches, batch_id_columns)])[['NAME'] + id_columns]
+    if all(columns == id_columns for columns in batch_id_columns):
+        df_labels = df_labels[~df_labels.index.duplicated()]
+    else:
+        df_labels = df_labels.groupby(level = 0, sort = False).first()
+
+    df_combined = pd.concat([df_labels] + [batch.drop(
+        columns = ['NAME'] + columns) for batch, columns 
+        in zip(indexed_batches, batch_id_columns)], axis = 1)
+    if column_names is not None:
+        df_combined.columns = ['NAME'] + id_columns + list(column_names)
+
+    if 'zip code tabulation area' in df_combined.columns:
+        df_combined.drop('zip code tabulation area', axis = 1, inplace = True)
+    # Outer merges on 'NAME' sorted their output by name, so the rows are
+    # sorted the same way here. (A stable sort keeps regions that share a
+    # name in the order in which the API returned them.)
+    df_combined.sort_values('NAME', kind = 'stable', inplace = True)
+    df_combined.reset_index(drop = True, inplace = True)
+    _record_span('assemble', start_time, rows = len(df_combined), 
+    columns = len(df_combined.columns))
+    return df_combined
+
+
+_census_sentinel_values = [-111111111, -222222222, -333333333, -555555555,
+-666666666, -888888888, -999999999]
+# Annotation codes that the Census API returns in place of estimates and
+# margins of error (e.g. -666666666 when too few sample observations were
+# available to compute an estimate). These are replaced with missing values
+# so that they don't distort sums and means.
+
+
+def _convert_to_numeric(df, skip_columns = 1, compact_dtypes = True):
+    '''Converts every column of df after the first skip_columns columns
+    (which store region names) into numerical values, then returns the
+    resulting DataFrame.
+
+    All value columns are parsed as a single float64 array, after which
+    Census annotation codes (see _census_sentinel_values) are replaced
+    with missing values.
+
+    compact_dtypes: if True, each column will be stored using the smallest
+    data type that can hold its values without any loss of precision: 
+    'Int32' (or 'Int64') for whole numbers and float32 (or float64) for
+    other values. The nullable 'Int' types allow whole-number columns to
+    contain missing values. If False, all value columns will be float64.
+    '''
+    start_time = time.perf_counter()
+    # The values are converted as a single NumPy array, which avoids
+    # pandas' per-column overhead. (If _parse_census_json already stored 
+    # them as float64 values, no conversion is needed.)
+    values = df.iloc[:, skip_columns:].to_numpy(dtype = 'float64')
+    values = np.where(np.isin(values, _census_sentinel_values), 
+    np.nan, values)
+    df_values = pd.DataFrame(values, index = df.index, 
+    columns = df.columns[skip_columns:])
+
+    if compact_dtypes and len(df_values.columns) > 0:
+        missing = np.isnan(values)
+        whole_numbers = ((values % 1 == 0) | missing).all(axis = 0)
+        fits_int32 = ((np.abs(values) <= 2**31 - 1) | missing).all(axis = 0)
+        fits_int64 = ((np.abs(values) <= 2**53) | missing).all(axis = 0)
+        fits_float32 = ((values.astype('float32').astype('float64') 
+        == values) | missing).all(axis = 0)
+        compact_columns = []
+        for i in range(len(df_values.columns)):
+            if whole_numbers[i] and fits_int32[i]:
+                dtype = 'Int32'
+            elif whole_numbers[i] and fits_int64[i]:
+                dtype = 'Int64'
+            elif fits_float32[i]:
+                dtype = 'float32'
+            else:
+                dtype = 'float64'
+            compact_columns.append(df_values.iloc[:, i].astype(dtype))
+        df_values = pd.concat(compact_columns, axis = 1)
+
+    # Columns are combined by position (rather than by name) in case
+    # two columns share the same description.
+    df_numeric = pd.concat([df.iloc[:, :skip_columns], df_values], axis = 1)
+    _record_span('numeric', start_time, rows = len(df_numeric), 
+    columns = len(df_values.columns))
+    return df_numeric
+
+
+def _build_batch_request_strings(df_variable_list, year, source_string,
+region_strings, api_key):
+    '''Returns a list of URLs that, together, retrieve every variable in
+    df_variable_list in batches of up to 45 variables.
+
+    region_strings: a list of geography clauses (see _get_region_strings).
+    Each item in the returned list is itself a list that contains one URL
+    per geography clause (i.e. per shard) for that batch.'''
+    request_strings = []
+    # First, the function creates a string (variable_string) containing codes 
+    # for up to 45 variables.
+    for start_point in range(0, len(df_variable_list), 45):
+        end_point = min(start_point + 45, len(df_variable_list)) # variables 
+        # will stop being added to the list once (A) the end of the DataFrame 
+        # is reached or (B) variable_string contains 45 variables.
+        variable_string = ','.join(
+            df_variable_list['Variable'].iloc[start_point:end_point])
+
+        # Next, the actual URL(s) for the API call will be initialized.
+        request_strings.append(['https://api.census.gov/data/'+str(year)+\
+            source_string+'?get=NAME,'+variable_string+\
+                region_string+'&key='+api_key 
+                for region_string in region_strings])
+    return request_strings
+
+
+def _get_batch_messages(variable_count, label = None):
+    '''Returns the progress message that will be printed as each batch 
+    created by _build_batch_request_strings is retrieved (e.g. 'Retrieving
+    data from rows 0 to 44'). If provided, label (e.g. a year) is added 
+    before the word 'data'.'''
+    # The last row is end_point - 1 due to how slice notation works.
+    return ['Retrieving '+('' if label is None else str(label)+' ')+
+    'data from rows '+str(start_point)+' to '+str(min(
+        start_point + 45, variable_count) - 1) 
+    for start_point in range(0, variable_count, 45)]
+
+
+def _finalize_region_data(df_region_data, year, region, compact_dtypes):
+    '''Adds a 'Year' column to data returned by _concat_on_geography,
+    cleans up zip code names, and converts all results columns into
+    numerical values.'''
+    df_region_data.insert(1, 'Year', year) # Stores the year of the Census data 
+    # as the first column in the DataFrame
+
+    # If 'zip' was selected as the region, the 'NAME' column of df_region_data
+    # contains 'ZCTA ' before each zip number. The following function removes
+    # this value, and then fills in any missing zip code numbers with zeroes.
+    # (Some zip codes begin with zeroes, and if these are converted to 
+    # numerical data, the leading zeroes will be removed. This shouldn't 
+    # occur in this case, but just in case, zfill is called to add those
+    # leading zeroes back in.)
+    if region == 'zip':
+        df_region_data['NAME'] = df_region_data['NAME'].str.replace(
+            'ZCTA5 ','').str.zfill(5) 
+
+    # All numerical results columns (e.g. all but the first column, which 
+    # stores region name information) are then converted into numerical
+    # values.
+    return _convert_to_numeric(df_region_data, compact_dtypes = compact_dtypes)
+
+
+def generate_variable_and_group_lists(year, source, variable_filter,
+index_path = None):
     '''
     This function retrieves all variables listed on the Census data page 
     for a given year and dataset. (See below for options for the 'source'
@@ -21,35 +1272,38 @@ def generate_variable_and_group_lists(year, source, variable_filter):
     the value for variable_filter. This will retrieve a table containing
     all rows, but it should still be useful.
 
-    '''
-
-    if source == 'acs5': # American Community Survey (5-year estimates)
-        source_string = '/acs/acs5'
+    index_path: the path to a local variable index (see 
+    build_variable_index). If provided, variables will be read from this
+    index (which will be built first if it doesn't yet cover this year and
+    source) instead of being parsed from the much larger variables.html
+    page.
 
-    if source == 'acs1': # American Community Survey (5-year estimates)
-        source_string = '/acs/acs1'
-
-    if source == 'census_redistricting': # US Decennial Census redistricting
-        # data
-        source_string = '/dec/pl'
-
-    if source == 'census_sf1': # US Decennial Census summary file data. 
-        source_string = '/dec/sf1'
-    
-    # Note: At the time of writing this function, 2020 US Census data was not
-    # yet fully available. Once it becomes available, I plan to add a new
-    # 'source' option that covers that data, as I don't believe it will exist
-    # under the /sf1 folder anymore.
+    '''
 
-    request_string = 'https://api.census.gov/data/'+str(year)+ \
-        source_string+'/variables.html'
-        # This variable stores the URL from which variable data will be 
-        # retrieved.
-    print("retrieving data from:",request_string)
+    if index_path is not None:
+        df_variables = _read_variable_index(year, source, index_path)
+        if df_variables is None:
+            build_variable_index(year, source, index_path)
+            df_variables = _read_variable_index(year, source, index_path)
+        df_variables.rename(columns={'Variable':'Name'},inplace=True)
+
+    else:
+        source_string = _get_source_string(source)
+
+        request_string = 'https://api.census.gov/data/'+str(year)+ \
+            source_string+'/variables.html'
+            # This variable stores the URL from which variable data will be 
+            # retrieved.
+        print("retrieving data from:",request_string)
+
+        response_text = _get_response_text(request_string)
+        start_time = time.perf_counter()
+        df_variables = pd.read_html(StringIO(response_text))[0]
+        _record_span('parse', start_time, rows = len(df_variables),
+        columns = len(df_variables.columns))
+        # read_html returns a list of DataFrames, but only the first one is 
+        # needed (hence the inclusion of 0 [0])
 
-    df_variables = pd.read_html(request_string)[0]
-    # read_html returns a list of DataFrames, but only the first one is needed
-    # (hence the inclusion of 0 [0])
     df_variables = df_variables.loc[df_variables['Label'].str.contains(
         variable_filter)].copy() 
         # Filters the DataFrame to exclude rows that do not contain variable
@@ -80,7 +1334,174 @@ def generate_variable_and_group_lists(year, source, variable_filter):
 
 
 
-def retrieve_census_data(df_variable_list, year, source, region, api_key):
+_default_variable_index_path = 'census_variable_index.sqlite'
+
+
+def _connect_to_variable_index(index_path):
+    '''Opens (and, if needed, initializes) a variable index database.
+    Returns the connection along with a boolean that indicates whether 
+    SQLite's FTS5 full-text search extension is available.'''
+    connection = sqlite3.connect(index_path)
+    connection.executescript('''
+        CREATE TABLE IF NOT EXISTS indexed_datasets (
+            year TEXT, source TEXT, built_at REAL, 
+            PRIMARY KEY (year, source));
+        CREATE TABLE IF NOT EXISTS variables (
+            year TEXT, source TEXT, Variable TEXT, Label TEXT, 
+            Concept TEXT, "Group" TEXT, 
+            PRIMARY KEY (year, source, Variable));
+        CREATE INDEX IF NOT EXISTS variables_group 
+            ON variables (year, source, "Group");
+        CREATE INDEX IF NOT EXISTS variables_concept 
+            ON variables (year, source, Concept);
+        CREATE INDEX IF NOT EXISTS variables_label 
+            ON variables (year, source, Label);
+    ''')
+    try:
+        connection.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS 
+        variables_fts USING fts5(year UNINDEXED, source UNINDEXED, 
+        Variable UNINDEXED, Label, Concept)''')
+        fts_available = True
+    except sqlite3.OperationalError: # Some SQLite builds lack FTS5.
+        fts_available = False
+    return connection, fts_available
+
+
+def build_variable_index(year, source, 
+index_path = _default_variable_index_path):
+    '''This function downloads the variables.json file for a given year and
+    source (see generate_variable_and_group_lists for source options) and
+    stores its contents within a local SQLite database at index_path. 
+    variables.json contains the same information as the variables.html
+    page that generate_variable_and_group_lists reads, but it is much
+    faster to parse.
+
+    The index can store many years and sources at once. Calling this 
+    function again for a year and source that are already present will
+    replace their existing entries. The index includes lookups on the
+    Variable, Group, Concept and Label fields, plus a full-text search table
+    (see search_variables).
+
+    Returns the number of variables that were added to the index.
+    '''
+
+    request_string = 'https://api.census.gov/data/'+str(year)+\
+        _get_source_string(source)+'/variables.json'
+    print("retrieving data from:",request_string)
+    variables = json.loads(_get_response_text(request_string))['variables']
+
+    # Variables without a concept or group (such as 'NAME' and 'for') are
+    # stored with null values, just as they appear as blank cells on
+    # variables.html.
+    rows = [(str(year), source, variable, info.get('label'), 
+    info.get('concept'), info.get('group')) 
+    for variable, info in variables.items()]
+
+    connection, fts_available = _connect_to_variable_index(index_path)
+    with connection:
+        connection.execute(
+            'DELETE FROM variables WHERE year = ? AND source = ?', 
+            (str(year), source))
+        connection.executemany('INSERT INTO variables VALUES (?,?,?,?,?,?)', 
+        rows)
+        if fts_available:
+            connection.execute('''DELETE FROM variables_fts 
+            WHERE year = ? AND source = ?''', (str(year), source))
+            connection.executemany(
+                'INSERT INTO variables_fts VALUES (?,?,?,?,?)', 
+                [row[:5] for row in rows])
+        connection.execute(
+            'INSERT OR REPLACE INTO indexed_datasets VALUES (?,?,?)', 
+            (str(year), source, time.time()))
+    connection.close()
+    return len(rows)
+
+
+def _is_indexed(connection, year, source):
+    '''Returns True if a given year and source have been added to the 
+    variable index that connection is connected to.'''
+    return connection.execute('''SELECT 1 FROM indexed_datasets 
+    WHERE year = ? AND source = ?''', 
+    (str(year), source)).fetchone() is not None
+
+
+def _read_variable_index(year, source, index_path, group = None):
+    '''Returns all variables stored in the index for a given year and 
+    source (or, if group is provided, only the variables within that 
+    group), or None if that year and source haven't been indexed.'''
+    if not os.path.exists(index_path):
+        return None
+    connection, _ = _connect_to_variable_index(index_path)
+    try:
+        if not _is_indexed(connection, year, source):
+            return None
+        if group is not None:
+            return pd.read_sql_query('''SELECT Variable, Label, Concept, 
+            "Group" FROM variables WHERE year = ? AND source = ? 
+            AND "Group" = ? ORDER BY Variable''', connection, 
+            params = (str(year), source, group))
+        return pd.read_sql_query('''SELECT Variable, Label, Concept, "Group"
+        FROM variables WHERE year = ? AND source = ? ORDER BY Variable''',
+        connection, params = (str(year), source))
+    finally:
+        connection.close()
+
+
+def search_variables(year, source, query, 
+index_path = _default_variable_index_path, prefix = False):
+    '''This function searches the variable index (see build_variable_index)
+    for a given year and source, which will be built first if needed.
+
+    query: the text to search for. By default, a full-text search of each
+    variable's label and concept is performed (e.g. 'median household 
+    income' will match variables whose label or concept contains all three
+    words). 
+
+    prefix: if True, only variables whose labels begin with query will be
+    returned (e.g. 'Estimate!!Total:!!Male:').
+
+    Returns a DataFrame with the same columns as the variable table from
+    generate_variable_and_group_lists.
+    '''
+    connection, fts_available = _connect_to_variable_index(index_path)
+    try:
+        if not _is_indexed(connection, year, source):
+            build_variable_index(year, source, index_path)
+        if prefix:
+            # This range comparison (rather than LIKE) allows SQLite to
+            # use the index on the Label column.
+            df_results = pd.read_sql_query('''SELECT Variable, Label, 
+            Concept, "Group" FROM variables WHERE year = ? AND source = ? 
+            AND Label >= ? AND Label < ? ORDER BY Variable''', connection,
+            params = (str(year), source, query, query + '\U0010ffff'))
+        elif fts_available:
+            # Each word is quoted so that punctuation within the query 
+            # isn't interpreted as FTS5 syntax.
+            match_string = ' '.join('"'+word.replace('"', '""')+'"' 
+            for word in query.split())
+            df_results = pd.read_sql_query('''SELECT v.Variable, v.Label, 
+            v.Concept, v."Group" FROM variables_fts f JOIN variables v 
+            ON v.year = f.year AND v.source = f.source 
+            AND v.Variable = f.Variable WHERE variables_fts MATCH ? 
+            AND f.year = ? AND f.source = ? ORDER BY v.Variable''', 
+            connection, params = (match_string, str(year), source))
+        else:
+            df_results = pd.read_sql_query('''SELECT Variable, Label, 
+            Concept, "Group" FROM variables WHERE year = ? AND source = ? 
+            AND (Label LIKE ? OR Concept LIKE ?) ORDER BY Variable''',
+            connection, params = (str(year), source, 
+            '%'+query+'%', '%'+query+'%'))
+    finally:
+        connection.close()
+    df_results['Description'] = df_results['Concept'] +\
+        ' ' + df_results['Label']
+    return df_results
+
+
+def retrieve_census_data(df_variable_list, year, source, region, api_key,
+max_workers = 1, requests_per_second = None, compact_dtypes = True,
+skip_invalid_variables = False, states = None, checkpoint_dir = None,
+return_summary = False):
     ''' This function retrieves data from the US Census Bureau in batches
     of 45 variables at a time. (See below for options for the 'source'
     variable.)
@@ -90,14 +1511,57 @@ def retrieve_census_data(df_variable_list, year, source, region, api_key):
     returns a variable table that can then be filtered by the user to create 
     df_variable_list.
 
-    region: Can be 'zip', 'county', or 'state'. The function will then
-    retrieve data for that region.
+    region: Can be 'zip', 'county', 'state', 'tract', or 'block group'. The
+    function will then retrieve data for that region.
 
     year: the year for which to retrieve Census data.
 
     api_key: a US Census API key. You can download one for free at
     https://api.census.gov/data/key_signup.html .
 
+    states: an optional state FIPS code or list of codes (e.g. ['01', '51'])
+    to which the results will be limited. Each batch will then be requested
+    separately for each state (with the state-level results stacked back
+    together afterwards), which keeps individual responses small and
+    allows these requests to be run in parallel. Enter 'all' to split a
+    nationwide request into one request per state. Tract and block group
+    data can only be requested one state at a time, so these regions will
+    use 'all' if no states are specified. 
+
+    max_workers: the maximum number of batches to retrieve at the same time.
+    The default value of 1 retrieves each batch in turn; higher values
+    can greatly reduce the runtime of requests involving many variables.
+    The batches are still combined in their original variable order.
+
+    requests_per_second: an optional limit on how many requests per second
+    get sent to the Census API (which can be helpful when max_workers is
+    high). None (the default) applies no limit.
+
+    compact_dtypes: if True (the default), each results column will be
+    stored using the smallest data type that can hold its values without
+    losing precision (e.g. 'Int32' for counts). Set to False to store all 
+    results as float64 values. In either case, Census annotation codes 
+    such as -666666666 are replaced with missing values.
+
+    skip_invalid_variables: if True, the variables will first be checked
+    using find_invalid_variables, and any invalid variables will be left
+    out of the results (rather than causing the entire batch that contains
+    them to fail). The check requests data for a single state (rather than
+    the whole region), so it adds little to the amount of data that gets
+    downloaded.
+
+    checkpoint_dir: an optional folder in which each batch will be saved as
+    soon as it has been retrieved. If the function fails partway through
+    (e.g. because of a network outage), calling it again with the same
+    arguments and checkpoint_dir will only retrieve the batches that are 
+    still missing. Use a separate folder for each set of arguments.
+
+    return_summary: if True, the function will return a tuple containing
+    the results and a summary DataFrame that shows how much time was spent
+    on requests, parsing, assembly, and numerical conversion (along with 
+    the bytes, rows, and columns processed by each stage). See 
+    summarize_instrumentation for more details.
+
     Note: the Examples pages on the Census website (such as
     https://api.census.gov/data/2019/acs/acs5/examples.html for acs5 data
     and https://api.census.gov/data/2010/dec/sf1/examples.html for decennial
@@ -106,166 +1570,330 @@ def retrieve_census_data(df_variable_list, year, source, region, api_key):
 
     '''
 
-    extra_columns = {} # Will store extra columns that will get added back
-    # after variable data is retrieved
-
-    if source == 'acs5': # American Community Survey (5-year estimates)
-        source_string = '/acs/acs5'
-
-    if source == 'acs1': # American Community Survey (5-year estimates)
-        source_string = '/acs/acs1'
-
-    if source == 'census_redistricting': # US Decennial Census redistricting
-        # data
-        source_string = '/dec/pl'
-
-    if source == 'census_sf1': # US Decennial Census summary file data. 
-        source_string = '/dec/sf1'
+    if return_summary:
+        return _run_with_summary(retrieve_census_data, locals())
+
+    source_string = _get_source_string(source)
+
+    region_strings = _get_region_strings(
+        region, states, year, source_string, api_key)
+
+    if skip_invalid_variables:
+        # The API rejects unknown variables regardless of the geography 
+        # being requested, so the variables are checked using a single 
+        # state's data (which is far smaller than a full zip code or 
+        # county response).
+        df_invalid = _find_invalid_variables(df_variable_list, year, 
+        source_string, _get_region_string('state', '01'), api_key, 
+        max_workers = max_workers, requests_per_second = requests_per_second)
+        if len(df_invalid) > 0:
+            print("Skipping invalid variables:",
+            ', '.join(df_invalid['Variable']))
+            df_variable_list = df_variable_list.loc[~df_variable_list[
+                'Variable'].isin(df_invalid['Variable'])]
+        if len(df_variable_list) == 0:
+            raise ValueError('None of the variables in df_variable_list '
+            'can be retrieved for the '+str(year)+' '+str(source)+
+            ' dataset and the '+str(region)+' region.')
+
+    # The following function call creates the URLs that will retrieve data
+    # from the Census website in groups of 45 variables at a time (with one
+    # URL per state for each group if the request is being split by state).
+    request_strings = _build_batch_request_strings(
+        df_variable_list, year, source_string, region_strings, api_key)
+
+    # The data retrieved by each URL then gets stored into a DataFrame.
+    # If max_workers is greater than 1, several of these batches will be
+    # retrieved at once.
+    batch_requests = _fetch_sharded_batches(
+        request_strings, max_workers = max_workers, 
+        requests_per_second = requests_per_second, 
+        checkpoint_dir = checkpoint_dir, 
+        batch_messages = _get_batch_messages(len(df_variable_list)))
+
+    # Each batch is then indexed by its geography identifier columns (e.g.
+    # 'state' and 'county' for county data), which are unique for each
+    # region (unlike the 'NAME' column: several states have counties with
+    # the same name). Because all batches share this index, they can be
+    # combined in a single pd.concat() call rather than through one merge
+    # per batch.
+    # The variable ID columns (e.g. 'B01001_001E') are also replaced with
+    # the more intuitive (but much longer) values in df_variable_list's 
+    # 'Description' column.
+    df_region_data = _concat_on_geography(
+        batch_requests, df_variable_list['Description'])
+
+    df_region_data = _finalize_region_data(
+        df_region_data, year, region, compact_dtypes)
     
-    # Note: At the time of writing this function, 2020 US Census data was not
-    # yet fully available. Once it becomes available, I plan to add a new
-    # 'source' option that covers that data, as I don't believe it will exist
-    # under the /sf1 folder anymore.
-
-    if region == 'zip':
-        region_string = '&for=zip%20code%20tabulation%20area:*'
-
-    if region == 'state':
-        region_string = '&for=state:*'
-
-    if region == 'county':
-        region_string = '&for=county:*&in=state:*'
-
-    # The following for loop retrieves data from the Census website in groups
-    # of 45 variables at a time.
-    # First, the function creates a string (variable_string) containing codes 
-    # for up to 45 variables.
-    for start_point in range(0, len(df_variable_list), 45):
-        variable_string = '' # This string will contain all the variables to be 
-        # retrieved from the Census API.
-        end_point = min(start_point + 45, len(df_variable_list)) # variables 
-        # will stop being added to the list once (A) the end of the DataFrame 
-        # is reached or (B) variable_string contains 45 variables.
-        for i in range(start_point, end_point):
-            if i != end_point-1:
-                variable_string += df_variable_list.iloc[i]['Variable'] + ','
-            else:
-                variable_string += df_variable_list.iloc[i]['Variable']
-        print("Retrieving data from rows",start_point,"to",end_point-1) # The 
-        # last row is not included due to how slice notation works
-
-        # Next, the actual URL for the API call will be initialized.
-
-        request_string = 'https://api.census.gov/data/'+str(year)+\
-            source_string+'?get=NAME,'+variable_string+\
-                region_string+'&key='+api_key
-    
-
-        # The data retrieved by this URL then gets stored into a DataFrame
-        # (batch_request).
-        batch_request = pd.read_json(request_string)
-
-        # The following two lines convert the first row of batch_request
-        # into the header, then drop that row from batch_request.
-        batch_request.columns = batch_request.iloc[0] 
-        batch_request = batch_request.iloc[1:]
-
-        # Depending on the region specified, there will also be 'state', 
-        # 'zip code tabulation area', or 'county' columns in the batch_request
-        # DataFrame. To simplify the table merging process, each extra
-        # column will be added to its own DataFrame and then dropped from
-        # batch_request. The extra columns will be merged back into the
-        # DataFrame containing all variables near the end of the function.
-
-        if 'state' in batch_request.columns:
-            if start_point == 0:
-                extra_columns['state'] = pd.DataFrame(
-                    batch_request[['NAME', 'state']])
-            batch_request.drop('state', axis = 1, inplace = True)
-            
-
-        if 'county' in batch_request.columns:
-            if start_point == 0:
-                extra_columns['county'] = pd.DataFrame(
-                    batch_request[['NAME', 'county']])
-            batch_request.drop('county', axis = 1, inplace = True)
-
-        # The zip code column does not contain any information not already
-        # present in the 'NAME' column, so it can be dropped.
-        if 'zip code tabulation area' in batch_request.columns:
-            batch_request.drop(
-                'zip code tabulation area', axis = 1, inplace = True)
-        
-        # Data from each iteration of the for loop will be stored in
-        # a DataFrame called df_region_data. The following code block
-        # either initializes df_region_data as batch_request (if df_county_data 
-        # does not yet exist) or merges the new copy of batch_request 
-        # into df_region_data.
-
-        if start_point == 0:
-            df_region_data = batch_request 
-        else:
-            df_region_data = df_region_data.merge(
-                batch_request, on = 'NAME', how = 'outer')
-
-
-    # Now that all variable data has been obtained from the census, changes can 
-    # be applied to the resulting dataframe as a whole.
-
-    # Currently, the column names are mostly ID-based (e.g. 'B01001_001E',
-    # 'B01002_001E', 'B06008_001E', 'B06008_003E'). To make them more intuitive
-    # (at the expense of dramatically increasing their length), they will be
-    #  replaced with values within df_variable_list's 'Description' column.
-
-    # Since the only columns in the DataFrame are the 'NAME' column
-    # and these variable ID columns, this is a good opportunity
-    # to rename the variable ID columns (as there are no other columns
-    # to deal with).
-    descriptions = ['NAME'] # This will remain as the first column
-    descriptions.extend(df_variable_list['Description'])
-    df_region_data.columns = descriptions
-
-
-    df_region_data.insert(1, 'Year', year) # Stores the year of the Census data 
-    # as the first column in the DataFrame
-
-    # Extra state/county/information columns that existed in earlier versions 
-    # of the dataset can now be merged back into the DataFrame.
-
-    if 'county' in extra_columns.keys():
-        df_region_data = df_region_data.merge(extra_columns['county'], 
-        on = 'NAME', how = 'outer')
-        df_region_data.insert(2, 'county', df_region_data.pop('county'))
+    return df_region_data
 
-    if 'state' in extra_columns.keys():
-        df_region_data = df_region_data.merge(extra_columns['state'], 
-        on = 'NAME', how = 'outer')
-        df_region_data.insert(2, 'state', df_region_data.pop('state'))
 
+def _get_checkpoint_subfolder(checkpoint_dir, name):
+    '''Returns the path of a subfolder of checkpoint_dir (or None if no
+    checkpoint_dir was provided).'''
+    if checkpoint_dir is None:
+        return None
+    return os.path.join(checkpoint_dir, name)
+
+
+def retrieve_census_group(group, year, source, region, api_key, 
+variable_filter = 'Estimate', include_margins_of_error = False, 
+index_path = _default_variable_index_path, max_workers = 1, 
+requests_per_second = None, compact_dtypes = True, states = None, 
+checkpoint_dir = None, return_summary = False):
+    '''This function retrieves every variable within a group (i.e. a 
+    table, such as 'B01001' for sex by age). Rather than requesting the
+    group's variables in batches of 45, it uses the API's group() syntax
+    (e.g. get=group(B01001)), which returns the entire table in a single
+    request (or one request per state if states is specified).
+
+    The group's variables and their descriptions are read from the 
+    variable index at index_path (see build_variable_index), which will be
+    built first if it doesn't yet cover this year and source. As a result,
+    only the first call for a given year and source needs to download 
+    variable metadata. (If index_path is None, the variables will be read
+    from variables.html instead; see generate_variable_and_group_lists.)
+
+    variable_filter: only variables whose labels contain this string will
+    be kept (see generate_variable_and_group_lists). 
+
+    include_margins_of_error: if True, each estimate's margin of error
+    (e.g. 'B01001_001M' for 'B01001_001E') will also be kept. Annotation
+    columns (such as 'B01001_001EA') are always left out.
+
+    If the API rejects the group request (e.g. because a dataset doesn't 
+    support group() queries), the group's variables will instead be 
+    retrieved in batches of 45 using retrieve_census_data. 
+    In either case, the output has the same format as that of 
+    retrieve_census_data, with the variables sorted by their codes. See
+    retrieve_census_data for documentation on the other arguments.
+
+    checkpoint_dir: the group request and (if needed) the batches of 45
+    are checkpointed within separate 'group' and 'batches' subfolders of
+    this folder, since each subfolder can only store one set of requests.
+    '''
 
-    # If 'zip' was selected as the region, the 'NAME' column of df_region_data
-    # contains 'ZCTA ' before each zip number. The following function removes
-    # this value, and then fills in any missing zip code numbers with zeroes.
-    # (Some zip codes begin with zeroes, and if these are converted to 
-    # numerical data, the leading zeroes will be removed. This shouldn't 
-    # occur in this case, but just in case, zfill is called to add those
-    # leading zeroes back in.)
-    if region == 'zip':
-        df_region_data['NAME'] = df_region_data['NAME'].str.replace(
-            'ZCTA5 ','').str.zfill(5) 
+    if return_summary:
+        return _run_with_summary(retrieve_census_group, locals())
+
+    if index_path is None:
+        df_variables = generate_variable_and_group_lists(
+            year, source, variable_filter)[0]
+        df_variables = df_variables.loc[df_variables['Group'] == group]
+    else:
+        # Only the group's variables are read from the index (using its
+        # lookup on the Group field), and they are then filtered and 
+        # described just as generate_variable_and_group_lists would.
+        df_variables = _read_variable_index(year, source, index_path, group)
+        if df_variables is None:
+            build_variable_index(year, source, index_path)
+            df_variables = _read_variable_index(
+                year, source, index_path, group)
+        df_variables = df_variables.loc[df_variables['Label'].str.contains(
+            variable_filter)].copy()
+        df_variables['Description'] = df_variables['Concept'] +\
+            ' ' + df_variables['Label']
+    df_variables = df_variables[['Variable', 'Description']]
+    if len(df_variables) == 0:
+        raise ValueError('No variables were found for group '+str(group)+
+        ' in the '+str(year)+' '+str(source)+' dataset.')
+    if include_margins_of_error:
+        df_margins = df_variables.loc[
+            df_variables['Variable'].str.endswith('E')].copy()
+        df_margins['Variable'] = df_margins['Variable'].str[:-1] + 'M'
+        df_margins['Description'] = df_margins['Description'] + \
+            ' (margin of error)'
+        df_variables = pd.concat([df_variables, df_margins]).drop_duplicates(
+            'Variable')
+    df_variables = df_variables.sort_values('Variable').reset_index(
+        drop = True)
+
+    source_string = _get_source_string(source)
+    region_strings = _get_region_strings(
+        region, states, year, source_string, api_key)
+    print("Retrieving group",group,"(",len(df_variables),"variables)")
+    request_strings = [['https://api.census.gov/data/'+str(year)+
+    source_string+'?get=group('+str(group)+')'+region_string+'&key='+
+    api_key for region_string in region_strings]]
+    try:
+        df_group = _fetch_sharded_batches(request_strings, 
+        max_workers = max_workers, requests_per_second = requests_per_second,
+        checkpoint_dir = _get_checkpoint_subfolder(checkpoint_dir, 'group')
+        )[0]
+    except urllib.error.HTTPError as error:
+        print("The group request failed (",error,"), so the group's "
+        "variables will be retrieved in batches of 45 instead.")
+        return retrieve_census_data(df_variables, year, source, region, 
+        api_key, max_workers = max_workers, 
+        requests_per_second = requests_per_second, 
+        compact_dtypes = compact_dtypes, states = states, 
+        checkpoint_dir = _get_checkpoint_subfolder(checkpoint_dir, 
+        'batches'))
+
+    # Group responses also contain a 'GEO_ID' column and annotation 
+    # columns, which are removed here. The remaining columns are arranged
+    # in the same order that retrieve_census_data would use.
+    df_group = df_group.loc[:, ~df_group.columns.duplicated()]
+    df_variables = df_variables.loc[df_variables['Variable'].isin(
+        df_group.columns)]
+    id_columns = [column for column in _geography_id_columns 
+    if column in df_group.columns]
+    df_group = _concat_on_geography([df_group[['NAME'] + id_columns + 
+    list(df_variables['Variable'])]], df_variables['Description'])
+
+    return _finalize_region_data(df_group, year, region, compact_dtypes)
+
+
+def stream_census_data(df_variable_list, year, source, region, api_key,
+max_workers = 1, requests_per_second = None, compact_dtypes = True,
+parquet_dir = None, states = None):
+    '''This function is a streaming version of retrieve_census_data. Rather
+    than combining all batches into one DataFrame, it yields each batch of
+    up to 45 variables as soon as it has been retrieved (in the original 
+    variable order). Each batch contains the same 'NAME', 'Year', 'state',
+    and 'county' columns as the output of retrieve_census_data, so only 
+    one batch (or, if max_workers is above 1, max_workers batches) needs to
+    be held in memory at a time.
+
+    Example: 
+    for df_batch in stream_census_data(df_variable_list, 2021, 'acs5', 
+    'zip', api_key):
+        process(df_batch)
+
+    parquet_dir: if provided, each batch will also be saved as a Parquet
+    file within a dataset folder partitioned by year, source, and region:
+    parquet_dir/year=2021/source=acs5/region=zip/batch_00000.parquet
+    (This requires the pyarrow library.) Because every batch stores 
+    different variables, the batch files can be combined by reading the
+    ones you need and calling pd.concat(axis = 1) on them (or by merging
+    them on their geography columns).
+
+    See retrieve_census_data for documentation on the other arguments.
+    '''
 
-    # The following for loop converts all numerical results
-    # columns (e.g. all but the first column, which stores region name
-    # information into numerical values.
+    source_string = _get_source_string(source)
+    region_strings = _get_region_strings(
+        region, states, year, source_string, api_key)
+    request_strings = _build_batch_request_strings(
+        df_variable_list, year, source_string, region_strings, api_key)
+
+    if parquet_dir is not None:
+        partition_dir = os.path.join(parquet_dir, 'year='+str(year), 
+        'source='+str(source), 'region='+str(region))
+        os.makedirs(partition_dir, exist_ok = True)
+
+    batches = _iter_sharded_batches(request_strings, 
+    max_workers = max_workers, requests_per_second = requests_per_second,
+    batch_messages = _get_batch_messages(len(df_variable_list)))
+    for batch_number, batch_request in enumerate(batches):
+        start_point = batch_number * 45
+        descriptions = df_variable_list['Description'].iloc[
+            start_point:start_point + 45]
+        df_batch = _concat_on_geography([batch_request], descriptions)
+        df_batch = _finalize_region_data(
+            df_batch, year, region, compact_dtypes)
+        if parquet_dir is not None:
+            df_batch.to_parquet(os.path.join(partition_dir, 
+            'batch_'+str(batch_number).zfill(5)+'.parquet'), index = False)
+        yield df_batch
+
+
+def retrieve_census_panel(df_variable_list, year_list, source, region, 
+api_key, max_workers = 1, requests_per_second = None, 
+compact_dtypes = True, states = None, checkpoint_dir = None,
+return_summary = False):
+    '''This function retrieves many variables across many years and 
+    returns them as a single panel DataFrame. Each row of this DataFrame
+    stores one region's data for one year.
+
+    df_variable_list: a list of variable codes (or a DataFrame with a
+    'Variable' column, such as the variable table from 
+    generate_variable_and_group_lists). The variable codes are used as the
+    panel's column names.
+
+    The variables for each year are packed into batches of 45 (the same 
+    batch size that retrieve_census_data uses), and the batches for all
+    years are retrieved together--up to max_workers at a time. The results
+    are then combined in a single assembly step. Geography names are 
+    retrieved alongside each batch, so no separate requests are needed.
+
+    The returned DataFrame is indexed by 'GEOID' (the region's geography
+    codes joined together, e.g. the state and county FIPS codes for 
+    counties, or the zip code for zip code tabulation areas) and 'Year'. 
+    Its columns are 'NAME', the 'state', 'county', 'tract', and 'block
+    group' columns (if present), and then one column for each variable. 
+    Regions that are missing from some years will only have rows for the
+    years in which they appear.
+
+    checkpoint_dir and return_summary work the same way as in 
+    retrieve_census_data. See retrieve_census_data for documentation on the
+    other arguments as well.
+    '''
 
-    for i in range(1, len(df_region_data.columns)):
-        df_region_data.iloc[:,i] = pd.to_numeric(df_region_data.iloc[:,i])
-    
-    return df_region_data
+    if return_summary:
+        return _run_with_summary(retrieve_census_panel, locals())
+
+    if isinstance(df_variable_list, pd.DataFrame):
+        variables = list(df_variable_list['Variable'])
+    else:
+        variables = list(df_variable_list)
+    df_panel_variables = pd.DataFrame({'Variable':variables})
+
+    source_string = _get_source_string(source)
+
+    # The URLs for every year are created up front so that they can all be
+    # retrieved by the same pool of workers.
+    request_strings = []
+    year_batch_counts = []
+    batch_messages = []
+    for year in year_list:
+        print("Preparing requests for:",year)
+        region_strings = _get_region_strings(
+            region, states, year, source_string, api_key)
+        year_request_strings = _build_batch_request_strings(
+            df_panel_variables, year, source_string, region_strings, api_key)
+        request_strings.extend(year_request_strings)
+        year_batch_counts.append(len(year_request_strings))
+        batch_messages.extend(_get_batch_messages(len(variables), year))
+
+    batches = _fetch_sharded_batches(request_strings, 
+    max_workers = max_workers, requests_per_second = requests_per_second,
+    checkpoint_dir = checkpoint_dir, batch_messages = batch_messages)
+
+    year_frames = []
+    batch_start = 0
+    for year, batch_count in zip(year_list, year_batch_counts):
+        df_year = _concat_on_geography(
+            batches[batch_start:batch_start + batch_count], variables)
+        batch_start += batch_count
+        if region == 'zip':
+            df_year['NAME'] = df_year['NAME'].str.replace(
+                'ZCTA5 ','').str.zfill(5)
+        geoid = format_geoids(compute_geoids(df_year, region), 
+        region).to_numpy()
+        df_year.insert(0, 'Year', year)
+        df_year.insert(0, 'GEOID', geoid)
+        year_frames.append(df_year)
+
+    # Not every year has the same geography columns (zip code data from
+    # 2016 and earlier has a 'state' column, for instance), so the columns
+    # are put back in a consistent order after the years are combined.
+    id_columns = [column for column in _geography_id_columns 
+    if any(column in df_year.columns for df_year in year_frames)]
+    df_panel = pd.concat(year_frames, ignore_index = True)[
+        ['GEOID', 'Year', 'NAME'] + id_columns + variables]
+    # GEOID, Year, NAME, and any state/county columns are kept as-is; 
+    # the remaining columns are converted into numerical values.
+    df_panel = _convert_to_numeric(df_panel, 
+    skip_columns = 3 + len(id_columns), compact_dtypes = compact_dtypes)
+    df_panel.set_index(['GEOID', 'Year'], inplace = True)
+    df_panel.sort_index(inplace = True)
+    return df_panel
 
 
 def retrieve_single_census_variable(region, year, source, column_name, 
-variable, api_key):
+variable, api_key, compact_dtypes = True):
 
     ''' This function is similar to retrieve_census_data except that it only
     obtains data for a single variable. (See retrieve_census_data for 
@@ -283,41 +1911,27 @@ variable, api_key):
 
     '''
 
-    if source == 'acs5':
-        source_string = '/acs/acs5'
-
-    if source == 'acs1':
-        source_string = '/acs/acs1'
+    source_string = _get_source_string(source)
 
-    if source == 'census_redistricting':
-        source_string = '/dec/pl'
-
-    if source == 'census_sf1':
-        source_string = '/dec/sf1'
-
-    if region == 'zip':
-        request_string = 'https://api.census.gov/data/'+str(year)+\
-            source_string+'?get=NAME,'+variable+\
-                '&for=zip%20code%20tabulation%20area:*&key='+api_key
-
-    if region == 'state':
-        request_string = 'https://api.census.gov/data/'+str(year)+\
-            source_string+'?get=NAME,'+variable+'&for=state:*&key='+api_key
-
-    if region == 'county':
-        request_string = 'https://api.census.gov/data/'+str(year)+\
-            source_string+'?get=NAME,'+variable+\
-                '&for=county:*&in=state:*&key='+api_key
+    request_string = 'https://api.census.gov/data/'+str(year)+\
+        source_string+'?get=NAME,'+variable+\
+            _get_region_string(region)+'&key='+api_key
     
-    df_result = pd.read_json(request_string)
+    df_result = _read_census_json(request_string)
+    return _finalize_single_variable(df_result, variable, column_name, year,
+    region, compact_dtypes)
 
-    df_result.columns = df_result.iloc[0] 
-    df_result = df_result.iloc[1:]
+
+def _finalize_single_variable(df_result, variable, column_name, year, 
+region, compact_dtypes):
+    '''Converts a single-variable response into the output format of 
+    retrieve_single_census_variable.'''
     # The column_name and year values will be used to create the name of
     # the column containing variable data.
     result_col = str(column_name)+'_'+str(year)
     df_result.rename(columns={variable:result_col},inplace=True)
-    df_result[result_col] = pd.to_numeric(df_result[result_col])
+    df_result = _convert_to_numeric(df_result[['NAME', result_col]], 
+    compact_dtypes = compact_dtypes)
 
     if region == 'zip':
         df_result['NAME'] = df_result['NAME'].str.replace(
@@ -327,52 +1941,144 @@ variable, api_key):
     return(df_result[['NAME', result_col]])
 
 
-def test_variables(df_variable_list, year, source, region, api_key):
-    ''' This function is designed to determine which variable codes are causing
-    the batch request process in retrieve_census_data to return an error.
-    See retrieve_census_data for additional documentation.
-    '''
+def find_invalid_variables(variable_list, year, source, region, api_key,
+max_workers = 1, requests_per_second = None, state = None):
+    '''This function determines which variable codes in variable_list 
+    cannot be retrieved for a given year, source, and region. 
 
-    if source == 'acs5':
-        source_string = '/acs/acs5'
+    Rather than testing each variable on its own, the function first tests
+    the variables in batches of 45 (as retrieve_census_data would request
+    them). Only batches that fail get split in half and retested; this 
+    process repeats until each invalid variable has been isolated. As a
+    result, a list of 900 variables with one bad code can be checked with
+    around 30 requests rather than 900.
 
-    if source == 'acs1':
-        source_string = '/acs/acs1'
+    variable_list: a list of variable codes (or a DataFrame with a 
+    'Variable' column).
 
-    if source == 'census_redistricting':
-        source_string = '/dec/pl'
+    max_workers and requests_per_second work the same way as in 
+    retrieve_census_data; each 45-variable batch is checked by a separate
+    worker.
 
-    if source == 'census_sf1':
-        source_string = '/dec/sf1'
+    state: an optional state FIPS code to which the requests will be 
+    limited. (This is required for tract and block group data.)
 
-    if region == 'zip':
-        region_string = '&for=zip%20code%20tabulation%20area:*'
+    Returns a DataFrame with one row per invalid variable. Its 'Variable'
+    column stores the variable code, and its 'Error' column stores the
+    error returned when that variable was requested on its own.
 
-    if region == 'state':
-        region_string = '&for=state:*'
+    Only responses that reject the request (HTTP 400 or 404 errors) are
+    treated as invalid variables; any other error (such as a server error
+    or a timeout) is raised.
+    '''
 
-    if region == 'county':
-        region_string = '&for=county:*&in=state:*'
+    return _find_invalid_variables(variable_list, year, 
+    _get_source_string(source), _get_region_string(region, state), api_key,
+    max_workers = max_workers, requests_per_second = requests_per_second)
 
-    for i in range(len(df_variable_list)):
 
-    
+def _find_invalid_variables(variable_list, year, source_string, 
+region_string, api_key, max_workers = 1, requests_per_second = None):
+    '''Performs the checks described in find_invalid_variables for an 
+    already-formatted source and geography clause.'''
+
+    if isinstance(variable_list, pd.DataFrame):
+        variable_list = variable_list['Variable']
+    variable_list = list(variable_list)
+
+    request_count = [0] # Stored in a list so that nested functions can
+    # update it
+    count_lock = threading.Lock()
+
+    def test_batch(variables):
+        '''Returns None if the variables can be retrieved together, or the
+        error message produced by the request otherwise.'''
         request_string = 'https://api.census.gov/data/'+str(year)+\
-            source_string+'?get=NAME,'+df_variable_list[i]+\
+            source_string+'?get=NAME,'+','.join(variables)+\
                 region_string+'&key='+api_key
+        if requests_per_second is not None:
+            _get_rate_limiter(request_string, requests_per_second).wait()
+        with count_lock:
+            request_count[0] += 1
+        try:
+            _get_response_text(request_string)
+            return None
+        except urllib.error.HTTPError as error:
+            # The API rejects unknown variables with a 400 (or 404) 
+            # response. Other errors, such as server errors that persisted
+            # after every retry, say nothing about the variables, so they
+            # are raised instead (as are connection errors, timeouts, and
+            # missing cache entries).
+            if error.code not in (400, 404):
+                raise
+            # The response body contains the API's explanation (e.g. 
+            # "error: unknown variable 'B01001_999E'").
+            explanation = error.read().decode('utf-8', 'replace').strip()
+            return str(error) + (' ('+explanation+')' if explanation else '')
+
+    def bisect(variables, error):
+        '''Returns a list of (variable, error) tuples for the invalid 
+        variables within a batch that is already known to have failed.'''
+        if len(variables) == 1:
+            return [(variables[0], error)]
+        midpoint = len(variables) // 2
+        left, right = variables[:midpoint], variables[midpoint:]
+        left_error = test_batch(left)
+        invalid_variables = [] if left_error is None else bisect(
+            left, left_error)
+        # If the left half succeeded, the right half must contain the
+        # invalid variable(s), so it doesn't need to be tested as a whole.
+        right_error = error if left_error is None else test_batch(right)
+        if right_error is not None:
+            invalid_variables.extend(bisect(right, right_error))
+        return invalid_variables
+
+    def check_batch(variables):
+        error = test_batch(variables)
+        return [] if error is None else bisect(variables, error)
+
+    batches = [variable_list[start_point:start_point + 45] 
+    for start_point in range(0, len(variable_list), 45)]
+    if max_workers <= 1:
+        results = [check_batch(batch) for batch in batches]
+    else:
+        with ThreadPoolExecutor(max_workers = max_workers) as executor:
+            futures = [_submit_in_context(executor, check_batch, batch) 
+            for batch in batches]
+            results = [future.result() for future in futures]
+
+    df_invalid = pd.DataFrame([invalid for result in results 
+    for invalid in result], columns = ['Variable', 'Error'])
+    print("Checked",len(variable_list),"variables using",request_count[0],
+    "requests;",len(df_invalid),"invalid variable(s) found.")
+    return df_invalid
 
-        try:            
-            pd.read_json(request_string)
-            # print("Data for:",variable_list[i],"retrieved successfully.")
-        except:
-            print("Failed to retrieve data for:",df_variable_list[i]+". \
+
+def test_variables(df_variable_list, year, source, region, api_key):
+    ''' This function is designed to determine which variable codes are causing
+    the batch request process in retrieve_census_data to return an error.
+    It prints a message for each invalid variable code and returns the 
+    DataFrame created by find_invalid_variables (which this function uses to
+    check the variables). See retrieve_census_data for additional 
+    documentation.
+    '''
+
+    df_invalid = find_invalid_variables(
+        df_variable_list, year, source, region, api_key)
+
+    for variable in df_invalid['Variable']:
+        print("Failed to retrieve data for:",variable+". \
 Confirm that the variable code was entered correctly and that this data \
 is available for the specified region.")
 
+    return df_invalid
+
 
 
 def compare_variable_across_years(variable, variable_name, source, 
-year_list, region, api_key):
+year_list, region, api_key, compact_dtypes = True, max_workers = 1,
+requests_per_second = None, long_format = False, checkpoint_dir = None,
+return_summary = False):
     '''
     This function retrieves Census data on a single variable across multiple
     years, then merges that data into a DataFrame. It then calculates
@@ -386,143 +2092,1034 @@ year_list, region, api_key):
     variable_name refers to the desired name for the variable column (e.g.
     'population' for a column containing population data.)
 
+    max_workers: the maximum number of years to retrieve at the same time.
+    (With a max_workers value at least as large as the number of years, 
+    the function will take roughly as long as a single request.)
+
+    long_format: if True, the function will return a 'tidy' DataFrame with
+    one row per region and year rather than one column per year. This
+    DataFrame has a 'Year' column, a variable_name column, and a
+    variable_name+'_chg' column that stores the percentage change from
+    the previous year in year_list (which is missing for the first year).
+
+    checkpoint_dir: an optional folder in which each year's data will be
+    saved as soon as it has been retrieved, allowing a failed call to be
+    resumed (see retrieve_census_data).
+
+    return_summary: if True, a summary of the time spent on each stage will
+    also be returned (see retrieve_census_data).
+
     See retrieve_census_data for additional documentation.
     '''
 
-    extra_columns = {}
+    if return_summary:
+        return _run_with_summary(compare_variable_across_years, locals())
 
-    if source == 'acs5':
-        source_string = '/acs/acs5'
+    df_data_across_years, id_columns = _retrieve_variable_across_years(
+        variable, variable_name, source, year_list, region, api_key, 
+        compact_dtypes, max_workers, requests_per_second, checkpoint_dir)
 
-    if source == 'acs1':
-        source_string = '/acs/acs1'
+    return _add_changes_across_years(df_data_across_years, id_columns,
+    variable_name, year_list, long_format)
 
-    if source == 'census_redistricting':
-        source_string = '/dec/pl'
 
-    if source == 'census_sf1':
-        source_string = '/dec/sf1'
+def _add_changes_across_years(df_data_across_years, id_columns, 
+variable_name, year_list, long_format = False):
+    '''Adds percentage change columns to the output of 
+    _retrieve_variable_across_years (or, if long_format is True, converts
+    it into a long DataFrame). See compare_variable_across_years.'''
+    # Next, percentage changes from each year to the next will be calculated,
+    # along with the change from the first year of data to the last.
+    # (See _calculate_changes.)
+    year_columns = [str(variable_name)+'_'+str(year) for year in year_list]
+    values = df_data_across_years[year_columns].to_numpy(
+        dtype = 'float64', na_value = np.nan)
+    change_columns = _get_change_columns(year_list, variable_name)
+    changes = _calculate_changes(values, change_columns)
+
+    if long_format:
+        # Each region's row is repeated once per year, and the matrices 
+        # are flattened row by row so that they line up with these rows.
+        # (The first len(year_list) - 1 change columns store the 
+        # year-to-year changes.)
+        df_long = df_data_across_years[['NAME'] + id_columns].loc[
+            df_data_across_years.index.repeat(len(year_list))].reset_index(
+                drop = True)
+        df_long['Year'] = list(year_list) * len(df_data_across_years)
+        df_long[variable_name] = values.ravel()
+        df_long[str(variable_name)+'_chg'] = np.hstack([np.full(
+            (len(values), 1), np.nan), changes[:, :len(year_list) - 1]
+            ]).ravel()
+        return df_long
+
+    df_data_across_years = pd.concat([df_data_across_years, pd.DataFrame(
+        changes, columns = list(change_columns), 
+        index = df_data_across_years.index)], axis = 1)
 
-    if region == 'zip':
-        region_string = '&for=zip%20code%20tabulation%20area:*'
+    return df_data_across_years
 
-    if region == 'state':
-        region_string = '&for=state:*'
 
-    if region == 'county':
-        region_string = '&for=county:*&in=state:*'
-    
+def _retrieve_variable_across_years(variable, variable_name, source, 
+year_list, region, api_key, compact_dtypes = True, max_workers = 1, 
+requests_per_second = None, checkpoint_dir = None):
+    '''Retrieves a single variable for each year in year_list and combines
+    the results into one DataFrame with a 'NAME' column, any 'state' and
+    'county' columns, and one variable_name+'_'+year column per year.
+    Returns this DataFrame along with the list of 'state'/'county' columns
+    that it contains. (See compare_variable_across_years.)'''
+    request_strings = _build_year_request_strings(
+        variable, source, year_list, region, api_key)
 
-    for i in range(len(year_list)):
-        year = year_list[i]
-        print("Retrieving data for:",year)
+    year_frames = _fetch_census_batches(request_strings, 
+    max_workers = max_workers, requests_per_second = requests_per_second,
+    checkpoint_dir = checkpoint_dir)
 
-        request_string = 'https://api.census.gov/data/'+str(year
-        )+source_string+'?get=NAME,'+variable+region_string+'&key='+api_key
-            
-        df_year = pd.read_json(request_string)
-
-        df_year.columns = df_year.iloc[0] 
-        df_year = df_year.iloc[1:]
-        # The following line renames each variable column based on
-        # variable_name and the current year in the for loop.
-
-        df_year.rename(columns={variable:str(
-            variable_name)+'_'+str(year)},inplace=True)
-        if 'state' in df_year.columns:
-            if i == 0:
-                extra_columns['state'] = pd.DataFrame(
-                    df_year[['NAME', 'state']])
-            df_year.drop('state', axis = 1, inplace = True)
-
-        if 'zip code tabulation area' in df_year.columns:
-            df_year.drop('zip code tabulation area', axis = 1, inplace = True)
-
-        if 'county' in df_year.columns:
-            if i == 0:
-                extra_columns['county'] = pd.DataFrame(
-                    df_year[['NAME', 'county']])
-            df_year.drop('county', axis = 1, inplace = True)
-
-        if i == 0:
-            df_data_across_years = df_year 
-        else:
-            df_data_across_years = df_data_across_years.merge(
-                df_year, on = 'NAME', how = 'outer')
+    return _combine_years(year_frames, variable, variable_name, year_list,
+    region, compact_dtypes)
 
-    # In order to calculate percentage changes, each data column must be
-    # converted to numerical format. (The first column contains each region's
-    # name and is thus skipped by the following for loop.)
-    for i in range(1, len(df_data_across_years.columns)):
-        df_data_across_years.iloc[:,i] = pd.to_numeric(
-            df_data_across_years.iloc[:,i])
 
+def _build_year_request_strings(variable, source, year_list, region, 
+api_key):
+    '''Returns one URL per year in year_list, each of which retrieves 
+    variable for every region of the given type.'''
+    source_string = _get_source_string(source)
 
-    # Next, percentage changes from each year to the next will be calculated,
-    # along with the change from the first year of data to the last.
+    region_string = _get_region_string(region)
+    
+    request_strings = []
+    for year in year_list:
+        print("Retrieving data for:",year)
+        request_strings.append('https://api.census.gov/data/'+str(year
+        )+source_string+'?get=NAME,'+variable+region_string+'&key='+api_key)
+    return request_strings
+
+
+def _combine_years(year_frames, variable, variable_name, year_list, region,
+compact_dtypes):
+    '''Combines the DataFrames retrieved by the URLs from 
+    _build_year_request_strings (see _retrieve_variable_across_years).'''
+    # The following loop renames each variable column based on
+    # variable_name and the year of its data.
+    year_columns = [str(variable_name)+'_'+str(year) for year in year_list]
+    for df_year, year_column in zip(year_frames, year_columns):
+        df_year.rename(columns={variable:year_column},inplace=True)
+
+    # The yearly DataFrames are then combined on their geography identifier
+    # columns (see _concat_on_geography). The 'state' and 'county' columns
+    # are set aside so that they won't be converted into numbers.
+    df_data_across_years = _concat_on_geography(year_frames)
+    id_columns = [column for column in ['state', 'county'] 
+    if column in df_data_across_years.columns]
+    df_id_columns = df_data_across_years[id_columns]
+    df_data_across_years.drop(id_columns, axis = 1, inplace = True)
+
+    # In order to calculate percentage changes, each data column must be
+    # converted to numerical format. (The first column contains each region's
+    # name and is thus skipped.)
+    df_data_across_years = _convert_to_numeric(
+        df_data_across_years, compact_dtypes = compact_dtypes)
 
-    data_column_count = len(df_data_across_years.columns)-1
-    # Stores the number of data columns, which is currently equal
-    # to the number of columns in the DataFrame minus one (the 
-    # region name column).
-
-    if data_column_count > 1: # If only one year was provided,
-        # it won't be possible to compute percentage changes.
-
-
-        # The following for loop starts at 2 so that it can skip the first
-        # column (which contains only region name information) and access
-        # the column containing the previous year's data (which will be 
-        # necessary in order to calculate a percentage change).
-        # It then creates a new column with percentage change information.
-        # [-1:-5:-1][::-1] converts column names with both variable names
-        # and years into just their years. 
-        # Adding [-1:-5:-1] to a column name first retrieves the last
-        # four characters of the column name (e.g. its year). However,
-        # these characters are in reversed order, so [::-1] is added on
-        # to re-reverse them.
-        # These years are then used within each percentage change column
-        # instead of the original variable column names in order to save space.
-        for i in range(2, data_column_count+1):
-            df_data_across_years[df_data_across_years.columns[
-            i-1][-1:-5:-1][::-1]+'_to_'+df_data_across_years.columns[
-            i][-1:-5:-1][::-1]+f'_{variable_name}_chg'] = (df_data_across_years[
-            df_data_across_years.columns[i]] / df_data_across_years[
-                df_data_across_years.columns[i-1]])-1
-
-        # If there are 4 or more columns (and thus three or more years
-        # being compared), then the following if statement
-        # will also calculate the percentage change from the first 
-        # data column to the last one.
-        # data_column_count is used instead of 
-        # len(df_data_across_years.columns) to determine the location of the
-        # final data column because the addition of percentage change columns
-        # has changed the total column count.
-        # Note that, if data_column_count is 3, then
-        # df_data_across_years[3] will access the 4th column in the DataFrame,
-        # which is indeed the location of the final data column.
-        if len(df_data_across_years.columns) > 3:
-            df_data_across_years[df_data_across_years.columns[
-            1][-1:-5:-1][::-1]+'_to_'+df_data_across_years.columns[
-                data_column_count][-1:-5:-1][::-1]+f'_{variable_name}_chg'] = (
-                    df_data_across_years[df_data_across_years.columns[
-                data_column_count]] / df_data_across_years[
-            df_data_across_years.columns[1]])-1
-
-    if 'county' in extra_columns.keys():
-        df_data_across_years = df_data_across_years.merge(
-            extra_columns['county'], on = 'NAME', how = 'outer')
-        df_data_across_years.insert(
-            1, 'county', df_data_across_years.pop('county'))
-
-    if 'state' in extra_columns.keys():
-        df_data_across_years = df_data_across_years.merge(
-            extra_columns['state'], on = 'NAME', how = 'outer')
-        df_data_across_years.insert(
-            1, 'state', df_data_across_years.pop('state'))
+    for column in reversed(id_columns):
+        df_data_across_years.insert(1, column, df_id_columns[column])
 
     if region == 'zip':
         df_data_across_years['NAME'] = \
             df_data_across_years['NAME'].str.replace('ZCTA5 ','').str.zfill(5) 
 
-    return df_data_across_years
+    return df_data_across_years, id_columns
+
+
+def _get_change_columns(year_list, variable_name):
+    '''Returns a dictionary that maps the name of each percentage change
+    column for year_list to the positions (within year_list) of the years
+    from and to which that change is calculated. These columns cover each 
+    year to the next and, if three or more years are being compared, the
+    first year to the last one.'''
+    # The years are used within each percentage change column's name
+    # (instead of the original variable column names) in order to save space.
+    change_columns = {}
+    for i in range(1, len(year_list)):
+        change_columns[str(year_list[i-1])+'_to_'+str(year_list[i])+
+        f'_{variable_name}_chg'] = (i - 1, i)
+
+    if len(year_list) > 2:
+        change_columns[str(year_list[0])+'_to_'+str(year_list[-1])+
+        f'_{variable_name}_chg'] = (0, len(year_list) - 1)
+    return change_columns
+
+
+def _calculate_changes(values, change_columns):
+    '''Returns a (region x change column) matrix of the percentage changes
+    (expressed in decimal format) described by change_columns (see 
+    _get_change_columns). values is a (region x year) matrix.
+
+    Every change is computed in a single operation: the matrix's 'to' year
+    columns are divided by its 'from' year columns. (Divisions by zero 
+    produce infinite values, as they did when these changes were 
+    calculated one column at a time.)'''
+    from_positions = [positions[0] for positions in change_columns.values()]
+    to_positions = [positions[1] for positions in change_columns.values()]
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return values[:, to_positions] / values[:, from_positions] - 1
+
+
+def update_variable_across_years(existing_table, variable, variable_name, 
+source, year_list, region, api_key, compact_dtypes = True, max_workers = 1,
+requests_per_second = None, checkpoint_dir = None, return_summary = False):
+    '''
+    This function brings a table created by compare_variable_across_years
+    (such as acs5_county_pop_2010_to_2020.csv) up to date. Only the years
+    that the table doesn't already contain are retrieved, so adding a newly
+    released year requires one request rather than one request per year.
+
+    existing_table: the DataFrame returned by compare_variable_across_years,
+    or the path to a .csv file in which that DataFrame was saved.
+
+    year_list: every year that the updated table should contain (e.g. the
+    table's current years followed by a newly released one). A year is 
+    retrieved only if the table has no variable_name+'_'+year column for
+    it; year columns that aren't in year_list are dropped.
+
+    Percentage change columns whose years were both already present in the
+    table are kept as-is. The remaining ones (e.g. the change from the 
+    previous last year to the new year, along with the change from the 
+    first year to the last) are calculated from the combined yearly 
+    values. The returned DataFrame has the same columns, in the same order,
+    as compare_variable_across_years would return for year_list. Regions 
+    that only appear in the new years are added to it.
+
+    See compare_variable_across_years for documentation on the other
+    arguments.
+    '''
+
+    if return_summary:
+        return _run_with_summary(update_variable_across_years, locals())
+
+    if isinstance(existing_table, pd.DataFrame):
+        df_existing = existing_table
+    else:
+        # The geography codes are read in as strings so that their leading
+        # zeros are preserved.
+        df_existing = pd.read_csv(existing_table, 
+        dtype = {'NAME':str, 'state':str, 'county':str})
+
+    year_columns = [str(variable_name)+'_'+str(year) for year in year_list]
+    existing_year_columns = [column for column in year_columns 
+    if column in df_existing.columns]
+    missing_years = [year for year, column in zip(year_list, year_columns)
+    if column not in df_existing.columns]
+
+    # Change columns can only be reused if both of their years were
+    # already present.
+    change_columns = _get_change_columns(year_list, variable_name)
+    reused_change_columns = [column for column, (i, j) in 
+    change_columns.items() if column in df_existing.columns and 
+    year_columns[i] in existing_year_columns and 
+    year_columns[j] in existing_year_columns]
+
+    geography_columns = [column for column in ['NAME', 'state', 'county']
+    if column in df_existing.columns]
+    df_updated = df_existing[geography_columns + existing_year_columns + 
+    reused_change_columns].copy()
+
+    if len(missing_years) == 0:
+        print("The table already contains data for every year in year_list.")
+    else:
+        print("Years to retrieve:",missing_years)
+        df_new_years, id_columns = _retrieve_variable_across_years(
+            variable, variable_name, source, missing_years, region, api_key,
+            compact_dtypes, max_workers, requests_per_second, checkpoint_dir)
+
+        # The new years are matched to the existing rows using their 
+        # GEOIDs (see compute_geoids). Codes that were read in as numbers 
+        # (e.g. by pd.read_csv without a dtype argument) are first padded 
+        # back to their original widths so that they match the new data.
+        label_columns = ['NAME'] + id_columns
+        for column in label_columns:
+            if column != 'NAME' or region == 'zip':
+                df_updated[column] = df_updated[column].astype(str).str.zfill(
+                    _geography_code_widths[column])
+        df_updated.index = compute_geoids(df_updated[label_columns], region)
+        df_new_years.index = compute_geoids(df_new_years[label_columns], 
+        region)
+
+        df_updated = df_updated.join(df_new_years.drop(
+            columns = label_columns), how = 'outer')
+        # Regions that only appear in the new years take their names and 
+        # codes from the new data.
+        for column in label_columns:
+            df_updated[column] = df_updated[column].fillna(
+                df_new_years[column])
+        # Rows are sorted the same way that compare_variable_across_years
+        # sorts them.
+        df_updated.sort_values('NAME', kind = 'stable', inplace = True)
+        df_updated.reset_index(drop = True, inplace = True)
+
+    # The remaining change columns are then calculated.
+    new_change_columns = {column:positions for column, positions in 
+    change_columns.items() if column not in reused_change_columns}
+    values = df_updated[year_columns].to_numpy(
+        dtype = 'float64', na_value = np.nan)
+    df_updated = pd.concat([df_updated, pd.DataFrame(
+        _calculate_changes(values, new_change_columns), 
+        columns = list(new_change_columns), index = df_updated.index)], 
+        axis = 1)
+
+    return df_updated[geography_columns + year_columns + list(change_columns)]
+
+
+def _get_job_variables(job, year, index_path, variable_tables):
+    '''Returns a DataFrame with 'Variable' and 'Description' columns that
+    lists every variable requested by job (see run_census_jobs) for a 
+    given year. Groups are expanded into their variables using the 
+    variable list for that year and source, which is stored within
+    variable_tables so that other jobs can reuse it.'''
+    variables = job.get('variables', [])
+    if isinstance(variables, dict): # Maps variable codes to descriptions
+        df_variables = pd.DataFrame({'Variable':list(variables), 
+        'Description':list(variables.values())})
+    else:
+        df_variables = pd.DataFrame({'Variable':list(variables), 
+        'Description':list(variables)})
+
+    if len(job.get('groups', [])) > 0:
+        table_key = (year, job['source'], job.get('variable_filter', 
+        'Estimate'))
+        if table_key not in variable_tables:
+            variable_tables[table_key] = generate_variable_and_group_lists(
+                year, job['source'], table_key[2], index_path = index_path)[0]
+        df_table = variable_tables[table_key]
+        df_variables = pd.concat([df_variables, df_table.loc[
+            df_table['Group'].isin(job['groups']), 
+            ['Variable', 'Description']]], ignore_index = True)
+    return df_variables.drop_duplicates('Variable').reset_index(drop = True)
+
+
+def run_census_jobs(jobs, api_key, output_dir = '.', max_workers = 1,
+requests_per_second = None, checkpoint_dir = None, 
+index_path = _default_variable_index_path, dry_run = False):
+    '''
+    This function runs a list of retrieval jobs together, which is much 
+    faster than calling retrieve_census_data once per job. (See
+    census_query_jobs.py for a command-line interface that reads these jobs
+    from a YAML or TOML file.)
+
+    jobs: a list of dictionaries, each of which describes one output table
+    using the following keys:
+    'name': the job's name. 
+    'source', 'region', and 'states': see retrieve_census_data. ('states'
+    is optional.)
+    'year' (a single year) or 'years' (a list of years, in which case each
+    year's rows will be stacked into one table with a 'Year' column).
+    'variables': a list of variable codes, or a dictionary that maps 
+    variable codes to the names of their output columns.
+    'groups': an optional list of groups (e.g. ['B01001']) whose variables
+    will also be retrieved. Their descriptions (see 
+    generate_variable_and_group_lists) will be used as column names.
+    'variable_filter': the variable_filter (see
+    generate_variable_and_group_lists) used when expanding groups. 
+    Defaults to 'Estimate'.
+    'output': the file (within output_dir) to which the table will be 
+    saved. Files ending in '.parquet' are saved in Parquet format; all 
+    others are saved as .csv files. Defaults to the job's name + '.csv'.
+    'compact_dtypes': see retrieve_census_data (defaults to True).
+
+    Requests are deduplicated across jobs: the variables of all jobs that
+    share the same source, year, region, and states are combined and 
+    retrieved only once, in batches of 45. All batches from all jobs are
+    then retrieved by a single pool of up to max_workers workers that 
+    shares one requests_per_second limit. Each job's table is then built
+    from the combined results.
+
+    checkpoint_dir: see retrieve_census_data. If a run fails, running the
+    same jobs again with the same checkpoint_dir will only retrieve the 
+    batches that are still missing.
+
+    index_path: the variable index (see build_variable_index) used when 
+    expanding groups.
+
+    dry_run: if True, the requests will be planned (and their number 
+    printed) but not retrieved.
+
+    Returns a dictionary that maps each job's name to the path of its 
+    output file (or, if output_dir is None, to its DataFrame).
+    '''
+    variable_tables = {}
+    request_variables = {} # Maps (source, year, region, states) keys to
+    # the combined variables of all jobs that share them
+    job_parts = [] # (job, key, df_job_variables) for each job and year
+    for job in jobs:
+        years = job['years'] if 'years' in job else [job['year']]
+        states = job.get('states')
+        if isinstance(states, list):
+            states = tuple(states) # Allows states to be used within keys
+        for year in years:
+            df_job_variables = _get_job_variables(
+                job, year, index_path, variable_tables)
+            key = (job['source'], year, job['region'], states)
+            request_variables[key] = pd.concat([request_variables.get(key),
+            df_job_variables[['Variable']]]).drop_duplicates()
+            job_parts.append((job, key, df_job_variables))
+
+    # The URLs for every key are created up front so that they can all be
+    # retrieved by the same pool of workers.
+    request_strings = []
+    batch_messages = []
+    key_batch_ranges = {}
+    undeduplicated_request_count = 0
+    for key, df_key_variables in request_variables.items():
+        source, year, region, states = key
+        if isinstance(states, tuple):
+            states = list(states)
+        source_string = _get_source_string(source)
+        region_strings = _get_region_strings(
+            region, states, year, source_string, api_key)
+        key_request_strings = _build_batch_request_strings(
+            df_key_variables, year, source_string, region_strings, api_key)
+        key_batch_ranges[key] = (len(request_strings), 
+        len(request_strings) + len(key_request_strings))
+        request_strings.extend(key_request_strings)
+        batch_messages.extend(_get_batch_messages(len(df_key_variables), 
+        str(year)+' '+str(source)+' '+region))
+        for job, job_key, df_job_variables in job_parts:
+            if job_key == key:
+                undeduplicated_request_count += -(-len(
+                    df_job_variables) // 45) * len(region_strings)
+
+    request_count = sum(len(shards) for shards in request_strings)
+    print("Running",len(jobs),"jobs using",request_count,"requests;",
+    undeduplicated_request_count,"would be needed without deduplication.")
+    if dry_run:
+        return {}
+
+    batches = _fetch_sharded_batches(request_strings, 
+    max_workers = max_workers, requests_per_second = requests_per_second,
+    checkpoint_dir = checkpoint_dir, batch_messages = batch_messages)
+    key_tables = {}
+    for key, (batch_start, batch_end) in key_batch_ranges.items():
+        key_tables[key] = _concat_on_geography(batches[batch_start:batch_end],
+        request_variables[key]['Variable'])
+    del batches
+
+    # Each job's table is then created from the combined results.
+    outputs = {}
+    for job in jobs:
+        year_frames = []
+        for part_job, key, df_job_variables in job_parts:
+            if part_job is not job:
+                continue
+            df_key_table = key_tables[key]
+            id_columns = [column for column in _geography_id_columns 
+            if column in df_key_table.columns]
+            df_year = df_key_table[['NAME'] + id_columns + list(
+                df_job_variables['Variable'])].copy()
+            df_year.columns = ['NAME'] + id_columns + list(
+                df_job_variables['Description'])
+            year_frames.append(_finalize_region_data(df_year, key[1], 
+            key[2], job.get('compact_dtypes', True)))
+        df_job = pd.concat(year_frames, ignore_index = True)
+
+        if output_dir is None:
+            outputs[job['name']] = df_job
+            continue
+        output_path = os.path.join(output_dir, job.get('output', 
+        job['name']+'.csv'))
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), 
+        exist_ok = True)
+        if output_path.endswith('.parquet'):
+            df_job.to_parquet(output_path, index = False)
+        else:
+            df_job.to_csv(output_path, index = False)
+        print("Saved",job['name'],"to",output_path)
+        outputs[job['name']] = output_path
+    return outputs
+
+
+_store_geography_columns = ['GEOID', 'NAME', 'Year', 'state', 'county', 
+'tract', 'block group']
+# Columns that CensusResultStore keeps under their own names (and always
+# returns)
+
+
+class CensusResultStore:
+    '''A folder of saved results (e.g. the output of retrieve_census_data
+    or compare_variable_across_years) stored as Parquet files, which can be
+    read one column at a time. Reading 3 columns of a table with hundreds
+    of columns therefore only loads those 3 columns, rather than the entire
+    .csv file.
+
+    Each table's results columns are stored under short codes: the 
+    variable codes from df_variable_list (if provided when the table is 
+    saved) or codes such as 'c0001'. The mapping from these codes to the
+    original column names (e.g. long variable descriptions) is saved 
+    within the Parquet file itself, and the original names are restored
+    when the table is read.
+
+    Rows are stored in GEOID order (see compute_geoids), and geography 
+    codes are stored as zero-padded strings (e.g. '01' for Alabama). Rows
+    are written in groups of row_group_size rows, and Parquet keeps the 
+    minimum and maximum value of each column within each group. When 
+    reading rows for one state, for instance, groups that can't contain 
+    that state are skipped without being read.
+
+    store_dir: the folder in which tables will be stored. It will be 
+    created if it doesn't already exist.
+
+    This class requires pyarrow (pip install pyarrow).
+    '''
+
+    def __init__(self, store_dir = 'census_store', row_group_size = 10000):
+        if pa is None:
+            raise ImportError('CensusResultStore requires pyarrow '
+            '(pip install pyarrow).')
+        self.store_dir = store_dir
+        self.row_group_size = row_group_size
+        os.makedirs(store_dir, exist_ok = True)
+
+    def _path(self, name):
+        return os.path.join(self.store_dir, name + '.parquet')
+
+    def tables(self):
+        '''Returns the names of the tables in the store.'''
+        return sorted(file_name[:-len('.parquet')] for file_name in 
+        os.listdir(self.store_dir) if file_name.endswith('.parquet'))
+
+    def save(self, name, df, df_variable_list = None, region = None):
+        '''Saves df as the table name (replacing any existing table with 
+        that name).
+
+        df_variable_list: the DataFrame (with 'Variable' and 'Description'
+        columns) that was used to create df. If provided, results columns
+        will be stored under their variable codes. 
+
+        region: the type of region ('zip', 'state', 'county', 'tract', or 
+        'block group') stored in df. If None, tables whose names are all
+        five-digit codes will be treated as zip code tables. (This matters
+        for older zip code tables, which also contain a 'state' column.)
+
+        Tables without geography codes (or zip code names) are stored 
+        without a 'GEOID' column, and rows with missing codes are given
+        missing GEOIDs.
+        '''
+        df = df.copy()
+        # Each row's GEOID is added, and geography codes that were 
+        # converted into numbers (as retrieve_census_data does) are 
+        # converted back into zero-padded strings.
+        if region is None and 'NAME' in df.columns and df['NAME'].astype(
+            str).str.fullmatch(r'\d{5}').all():
+            region = 'zip'
+        if region == 'zip':
+            geoid_columns = ['NAME']
+        else:
+            geoid_columns = [column for column in _geography_id_columns 
+            if column in df.columns]
+        if 'GEOID' not in df.columns and len(geoid_columns) > 0:
+            complete_rows = df[geoid_columns].notna().all(axis = 1)
+            df.insert(0, 'GEOID', compute_geoids(df.loc[complete_rows, 
+            geoid_columns]).astype('Int64').reindex(df.index))
+        for column in ['state', 'county', 'tract', 'block group']:
+            if column in df.columns:
+                df[column] = pd.to_numeric(df[column]).astype('Int64').astype(
+                    'string').str.zfill(_geography_code_widths[column])
+        if 'GEOID' in df.columns:
+            df.sort_values('GEOID', kind = 'stable', inplace = True)
+
+        if df_variable_list is not None:
+            codes_by_description = dict(zip(
+                df_variable_list['Description'], df_variable_list['Variable']))
+        else:
+            codes_by_description = {}
+        column_codes = {}
+        for i, column in enumerate(df.columns):
+            if column in _store_geography_columns:
+                column_codes[column] = column
+            else:
+                column_codes[codes_by_description.get(column, 
+                'c'+str(i).zfill(4))] = column
+        if len(column_codes) < len(df.columns):
+            raise ValueError('Column names and variable codes must be '
+            'unique in order to be saved.')
+        df.columns = list(column_codes)
+
+        table = pa.Table.from_pandas(df, preserve_index = False)
+        table = table.replace_schema_metadata({**table.schema.metadata,
+        b'census_query_columns':json.dumps(column_codes).encode('utf-8')})
+        # The table is written to a temporary file first so that readers
+        # never see a partially written table.
+        file_descriptor, temp_path = tempfile.mkstemp(dir = self.store_dir)
+        os.close(file_descriptor)
+        pq.write_table(table, temp_path, row_group_size = self.row_group_size)
+        os.replace(temp_path, self._path(name))
+
+    def import_csv(self, name, csv_path, df_variable_list = None, 
+    region = None):
+        '''Saves a .csv file of results (e.g. 
+        acs5_2021_county_results.csv) as the table name. See save().'''
+        # Names are read in as strings so that zip codes keep their 
+        # leading zeros.
+        self.save(name, pd.read_csv(csv_path, dtype = {'NAME':str}),
+        df_variable_list, region)
+
+    def columns(self, name):
+        '''Returns a DataFrame listing the 'Code' and original 'Column' name
+        of each of the table's columns. Only the table's metadata is read.'''
+        column_codes = json.loads(pq.read_schema(self._path(name)).metadata[
+            b'census_query_columns'])
+        return pd.DataFrame({'Code':list(column_codes), 
+        'Column':list(column_codes.values())})
+
+    def read(self, name, columns = None, filters = None, 
+    use_codes = False):
+        '''Reads the table name, loading only the requested columns and 
+        rows. 
+
+        columns: the results columns to read (using either their original
+        names or their codes). The geography columns ('GEOID', 'NAME', 
+        'Year', 'state', etc.) are always included. None (the default) 
+        reads every column.
+
+        filters: the rows to read, as a dictionary that maps column names
+        to a value or list of values (e.g. {'state':'51'} or 
+        {'state':['01', '51']}), or as a list of pyarrow-style 
+        (column, operator, value) tuples (e.g. [('GEOID', '>=', 51000)]).
+        Geography codes may be given as numbers or strings.
+
+        use_codes: if True, the results columns will be named using their
+        codes rather than their original names.
+        '''
+        df_columns = self.columns(name)
+        codes = dict(zip(df_columns['Column'], df_columns['Code']))
+        codes.update(zip(df_columns['Code'], df_columns['Code']))
+
+        if columns is not None:
+            if isinstance(columns, str):
+                columns = [columns]
+            unknown_columns = [column for column in columns 
+            if column not in codes]
+            if len(unknown_columns) > 0:
+                raise KeyError('Columns not found in '+name+': '+
+                ', '.join(map(str, unknown_columns)))
+            requested_codes = [codes[column] for column in columns]
+            columns = [code for code in df_columns['Code'] if code in 
+            _store_geography_columns or code in requested_codes]
+
+        if isinstance(filters, dict):
+            filters = [(column, 'in' if isinstance(value, (list, tuple)) 
+            else '==', value) for column, value in filters.items()]
+        if filters is not None:
+            filters = [(codes.get(column, column), operator, 
+            self._format_filter_value(codes.get(column, column), value))
+            for column, operator, value in filters]
+
+        df = pq.read_table(self._path(name), columns = columns, 
+        filters = filters).to_pandas()
+        if not use_codes:
+            df.columns = df.columns.map(dict(zip(df_columns['Code'], 
+            df_columns['Column'])))
+        return df
+
+    @staticmethod
+    def _format_filter_value(column, value):
+        # Geography codes are stored as zero-padded strings.
+        if column not in ['state', 'county', 'tract', 'block group']:
+            return value
+        if isinstance(value, (list, tuple)):
+            return [str(item).zfill(_geography_code_widths[column]) 
+            for item in value]
+        return str(value).zfill(_geography_code_widths[column])
+
+
+# Async API
+# The following functions are asyncio counterparts of retrieve_census_data,
+# retrieve_single_census_variable, and compare_variable_across_years for
+# use within asyncio applications (such as web services). Requests are
+# made using asyncio streams, so waiting for the Census API never blocks
+# the event loop; parsing and assembling responses, which is CPU-bound,
+# runs in a worker thread via asyncio.to_thread().
+
+
+class _ConnectionClosedError(ConnectionResetError):
+    '''Raised when a connection fails before any part of its response has
+    been received.'''
+
+
+class AsyncCensusHTTPClient:
+    '''An asyncio counterpart of CensusHTTPClient that reuses keep-alive
+    connections, applies a timeout to each request, retries connection
+    errors and 429/5xx responses (with the same jittered exponential
+    backoff), requests gzip-compressed responses, and supports base_url.
+    See CensusHTTPClient for documentation on these arguments.
+
+    max_concurrency: the maximum number of requests that can be in flight
+    at once across every call that shares this client. (Requests that are
+    waiting to be retried don't count toward this limit.)
+
+    Each client belongs to the event loop in which it is first used. The
+    async functions in this module share one client per event loop (see
+    configure_async_http_client).
+    '''
+
+    retry_statuses = CensusHTTPClient.retry_statuses
+    _retry_delay = CensusHTTPClient._retry_delay
+
+    def __init__(self, timeout = 60, max_retries = 4, backoff_factor = 0.5,
+    max_backoff = 30, pool_size = 16, base_url = None, max_concurrency = 10):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.pool_size = pool_size
+        self.base_url = base_url
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.idle_connections = {} # Maps (scheme, host, port) tuples to 
+        # lists of idle (reader, writer) pairs
+
+    async def _acquire(self, key):
+        '''Returns an idle connection for key (or a new one if none are
+        available), along with whether the connection is being reused.'''
+        idle = self.idle_connections.get(key)
+        if idle:
+            return idle.pop(), True
+        scheme, host, port = key
+        return await asyncio.open_connection(host, port, 
+        ssl = ssl.create_default_context() if scheme == 'https' else None
+        ), False
+
+    def _discard_idle(self, key):
+        '''Closes all idle connections for key.'''
+        for reader, writer in self.idle_connections.pop(key, []):
+            writer.close()
+
+    def _release(self, key, connection):
+        idle = self.idle_connections.setdefault(key, [])
+        if len(idle) < self.pool_size:
+            idle.append(connection)
+        else:
+            connection[1].close()
+
+    def close(self):
+        '''Closes all idle connections.'''
+        for idle in self.idle_connections.values():
+            for reader, writer in idle:
+                try:
+                    writer.close()
+                except RuntimeError: # The client's event loop has closed.
+                    pass
+        self.idle_connections = {}
+
+    @staticmethod
+    async def _send(connection, host, path):
+        '''Sends a GET request over connection and reads the response.
+        Returns its status, reason, headers, body, and whether the server
+        will close the connection.'''
+        reader, writer = connection
+        try:
+            writer.write(('GET '+path+' HTTP/1.1\r\nHost: '+host+
+            '\r\nAccept-Encoding: gzip\r\nUser-Agent: census_query'
+            '\r\n\r\n').encode('latin-1'))
+            await writer.drain()
+            status_line = await reader.readline()
+        except ConnectionError as error:
+            raise _ConnectionClosedError(str(error)) from error
+        if not status_line:
+            raise _ConnectionClosedError('The connection was closed.')
+        version, status, reason = (status_line.decode('latin-1').rstrip(
+            '\r\n') + ' ').split(' ', 2)
+        status = int(status)
+        header_lines = []
+        while True:
+            line = await reader.readline()
+            header_lines.append(line)
+            if line in (b'\r\n', b'\n', b''):
+                break
+        headers = http.client.parse_headers(BytesIO(b''.join(header_lines)))
+
+        will_close = version == 'HTTP/1.0' or headers.get(
+            'Connection', '').lower() == 'close'
+        if status in (204, 304) or status < 200:
+            body = b''
+        elif headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                chunk_size = int((await reader.readline()).split(b';')[0], 16)
+                if chunk_size == 0:
+                    # Skips any trailing headers.
+                    while (await reader.readline()) not in (
+                        b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(chunk_size))
+                await reader.readexactly(2) # The chunk's closing CRLF
+            body = b''.join(chunks)
+        elif headers.get('Content-Length') is not None:
+            body = await reader.readexactly(int(headers['Content-Length']))
+        else: # The body continues until the connection is closed.
+            body = await reader.read()
+            will_close = True
+        return status, reason.strip(), headers, body, will_close
+
+    async def get_bytes(self, request_string):
+        '''Retrieves request_string and returns the (decompressed) response
+        body along with the response's headers.'''
+        if self.base_url is not None and request_string.startswith(
+            _census_api_root):
+            request_string = self.base_url.rstrip('/') + request_string[
+                len(_census_api_root):]
+        url_parts = urlsplit(request_string)
+        key = (url_parts.scheme, url_parts.hostname, url_parts.port or (
+            443 if url_parts.scheme == 'https' else 80))
+        path = url_parts.path + ('?' + url_parts.query 
+        if url_parts.query else '')
+
+        attempt = 0
+        while True:
+            connection = None
+            reused = False
+            try:
+                # The semaphore is only held while a request is in flight,
+                # so requests that are waiting to be retried don't hold up
+                # other requests.
+                async with self.semaphore:
+                    connection, reused = await asyncio.wait_for(
+                        self._acquire(key), self.timeout)
+                    status, reason, headers, body, will_close = \
+                        await asyncio.wait_for(self._send(connection, 
+                        url_parts.netloc, path), self.timeout)
+            except (OSError, asyncio.TimeoutError, 
+            asyncio.IncompleteReadError, ValueError) as error:
+                if connection is not None:
+                    connection[1].close()
+                if reused and isinstance(error, _ConnectionClosedError):
+                    # The server closed this idle connection before the
+                    # request was sent (see CensusHTTPClient).
+                    self._discard_idle(key)
+                    continue
+                # Connection errors, timeouts, and malformed responses are
+                # retried using a new connection.
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(self._retry_delay(attempt))
+                attempt += 1
+                continue
+            except BaseException:
+                # If the request was cancelled partway through, the rest of
+                # its response may still arrive, so the connection can't be
+                # reused.
+                if connection is not None:
+                    connection[1].close()
+                raise
+
+            if will_close:
+                connection[1].close()
+            else:
+                self._release(key, connection)
+
+            if status in self.retry_statuses and (
+                attempt < self.max_retries):
+                await asyncio.sleep(self._retry_delay(
+                    attempt, headers.get('Retry-After')))
+                attempt += 1
+                continue
+            if headers.get('Content-Encoding', '').lower() == 'gzip':
+                body = gzip.decompress(body)
+            if status >= 400:
+                raise urllib.error.HTTPError(
+                    request_string.split('&key=')[0], status, reason, 
+                    headers, BytesIO(body))
+            return body, headers
+
+    async def get_text(self, request_string):
+        '''Retrieves request_string and returns the response body as a
+        string.'''
+        body, headers = await self.get_bytes(request_string)
+        return body.decode(headers.get_content_charset() or 'utf-8')
+
+
+_async_http_clients = weakref.WeakKeyDictionary() # Maps event loops to 
+# their shared AsyncCensusHTTPClient
+_async_http_client_settings = None # The keyword arguments passed to 
+# configure_async_http_client, if it has been called
+
+
+def configure_async_http_client(**kwargs):
+    '''Sets the keyword arguments (e.g. max_concurrency = 20 or 
+    timeout = 120) used to create the AsyncCensusHTTPClient that the async
+    functions in each event loop share. Clients that were already created
+    are closed and replaced the next time they are needed. 
+
+    Until this function is called (or if it is called without any 
+    arguments), the async clients use the timeout, retry, pool_size, and
+    base_url settings of the shared (synchronous) HTTP client (see 
+    configure_http_client).'''
+    global _async_http_client_settings
+    _async_http_client_settings = kwargs or None
+    for client in list(_async_http_clients.values()):
+        client.close()
+    _async_http_clients.clear()
+
+
+def _get_async_http_client():
+    '''Returns the running event loop's shared AsyncCensusHTTPClient,
+    creating it if necessary.'''
+    loop = asyncio.get_running_loop()
+    client = _async_http_clients.get(loop)
+    if client is None:
+        settings = _async_http_client_settings
+        if settings is None:
+            settings = {setting:getattr(_http_client, setting) for setting in
+            ['timeout', 'max_retries', 'backoff_factor', 'max_backoff', 
+            'pool_size', 'base_url']}
+        client = AsyncCensusHTTPClient(**settings)
+        _async_http_clients[loop] = client
+    return client
+
+
+async def _get_response_text_async(request_string):
+    '''An async counterpart of _get_response_text.'''
+    start_time = time.perf_counter()
+    # Reading from and writing to the response cache involves disk I/O 
+    # (and, if the cache has a size limit, scanning its folder), so the 
+    # cache is accessed from a worker thread in order to keep the event 
+    # loop responsive.
+    use_cache = _response_cache is not None
+    if use_cache:
+        body = await asyncio.to_thread(
+            _read_cached_response, request_string, start_time)
+        if body is not None:
+            return body
+    body = await _get_async_http_client().get_text(request_string)
+    if use_cache:
+        await asyncio.to_thread(
+            _save_response, request_string, body, start_time)
+    else:
+        _save_response(request_string, body, start_time)
+    return body
+
+
+async def _fetch_census_batch_async(request_string):
+    '''Retrieves and parses a single Census API response.'''
+    response_text = await _get_response_text_async(request_string)
+    return await asyncio.to_thread(_parse_census_json, response_text)
+
+
+async def _gather_or_cancel(coroutines):
+    '''Runs coroutines concurrently and returns their results in order.
+    If any of them fails (or the caller is cancelled), the others are 
+    cancelled rather than being left to run in the background.'''
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+async def _fetch_sharded_batches_async(request_strings, 
+batch_messages = None):
+    '''An async counterpart of _fetch_sharded_batches. Every shard of 
+    every batch is requested at once; the shared client's semaphore limits
+    how many requests are actually in flight.'''
+    for message in batch_messages or []:
+        print(message)
+    flat_request_strings = [request_string for shards in request_strings 
+    for request_string in shards]
+    frames = await _gather_or_cancel([_fetch_census_batch_async(
+        request_string) for request_string in flat_request_strings])
+    batches = []
+    position = 0
+    for shards in request_strings:
+        batches.append(_stack_shards(frames[position:position+len(shards)]))
+        position += len(shards)
+    return batches
+
+
+async def _get_region_strings_async(region, states, year, source_string, 
+api_key):
+    '''An async counterpart of _get_region_strings.'''
+    if (states is None and region in ('tract', 'block group')) or (
+        isinstance(states, str) and states == 'all'):
+        df_states = await _fetch_census_batch_async(
+            'https://api.census.gov/data/'+str(year)+source_string+
+            '?get=NAME&for=state:*&key='+api_key)
+        states = sorted(df_states['state'])
+    return _get_region_strings(region, states, year, source_string, api_key)
+
+
+async def retrieve_census_data_async(df_variable_list, year, source, region,
+api_key, compact_dtypes = True, states = None, timeout = None):
+    '''An async counterpart of retrieve_census_data. All batches (and 
+    shards) are requested concurrently, subject to the shared client's 
+    max_concurrency limit (see configure_async_http_client).
+
+    timeout: an optional limit (in seconds) on the entire call. If it is
+    exceeded, the call's outstanding requests are cancelled and a 
+    TimeoutError is raised. Cancelling the task that awaits this function
+    also cancels its outstanding requests.
+
+    See retrieve_census_data for documentation on the other arguments.
+    '''
+    async def retrieve():
+        source_string = _get_source_string(source)
+        region_strings = await _get_region_strings_async(
+            region, states, year, source_string, api_key)
+        request_strings = _build_batch_request_strings(
+            df_variable_list, year, source_string, region_strings, api_key)
+        batch_requests = await _fetch_sharded_batches_async(request_strings,
+        _get_batch_messages(len(df_variable_list)))
+        return await asyncio.to_thread(_assemble_region_data, 
+        batch_requests, df_variable_list['Description'], year, region, 
+        compact_dtypes)
+
+    return await asyncio.wait_for(retrieve(), timeout)
+
+
+def _assemble_region_data(batch_requests, column_names, year, region,
+compact_dtypes):
+    '''Combines and finalizes the batches retrieved by
+    retrieve_census_data_async.'''
+    return _finalize_region_data(_concat_on_geography(
+        batch_requests, column_names), year, region, compact_dtypes)
+
+
+async def retrieve_single_census_variable_async(region, year, source, 
+column_name, variable, api_key, compact_dtypes = True, timeout = None):
+    '''An async counterpart of retrieve_single_census_variable. See 
+    retrieve_census_data_async for documentation on timeout.'''
+    async def retrieve():
+        request_string = 'https://api.census.gov/data/'+str(year)+\
+            _get_source_string(source)+'?get=NAME,'+variable+\
+                _get_region_string(region)+'&key='+api_key
+        df_result = await _fetch_census_batch_async(request_string)
+        return await asyncio.to_thread(_finalize_single_variable, df_result,
+        variable, column_name, year, region, compact_dtypes)
+
+    return await asyncio.wait_for(retrieve(), timeout)
+
+
+async def compare_variable_across_years_async(variable, variable_name, 
+source, year_list, region, api_key, compact_dtypes = True, 
+long_format = False, timeout = None):
+    '''An async counterpart of compare_variable_across_years, which 
+    requests all years concurrently. See retrieve_census_data_async for
+    documentation on timeout.'''
+    async def retrieve():
+        request_strings = _build_year_request_strings(
+            variable, source, year_list, region, api_key)
+        year_frames = await _gather_or_cancel([_fetch_census_batch_async(
+            request_string) for request_string in request_strings])
+        return await asyncio.to_thread(_compare_year_frames, year_frames,
+        variable, variable_name, year_list, region, compact_dtypes, 
+        long_format)
+
+    return await asyncio.wait_for(retrieve(), timeout)
+
+
+def _compare_year_frames(year_frames, variable, variable_name, year_list,
+region, compact_dtypes, long_format):
+    '''Combines the yearly DataFrames retrieved by 
+    compare_variable_across_years_async and adds percentage changes.'''
+    df_data_across_years, id_columns = _combine_years(year_frames, variable,
+    variable_name, year_list, region, compact_dtypes)
+    return _add_changes_across_years(df_data_across_years, id_columns,
+    variable_name, year_list, long_format)
@@ -0,0 +1,280 @@
+# census_query_benchmark:
+# Measures the performance of census_query's functions against a local
+# stand-in for the Census API, so that changes to census_query.py can be
+# evaluated offline (and compared across versions).
+# Released under the MIT License
+
+# Example usage:
+# python census_query_benchmark.py --zctas 33000 --variables 90 --repeat 3
+# python census_query_benchmark.py --output new.json --compare old.json
+# python census_query_benchmark.py --replay-dir census_cache
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pandas as pd
+
+import census_query
+
+
+# The stages of census_query's pipeline (see census_query's instrumentation
+# section) whose times are reported separately.
+stages = ['request', 'parse', 'assemble', 'numeric']
+
+
+# Fake Census API
+
+def synthetic_geographies(zcta_count, county_count):
+    '''Returns lists of (NAME, geography column values) tuples for states,
+    counties, and zip code tabulation areas.'''
+    states = [(f'State {i:02d}', {'state':f'{i:02d}'}) for i in range(1, 53)]
+    counties = [(f'County {i}, State {i % 52 + 1:02d}',
+    {'state':f'{i % 52 + 1:02d}', 'county':f'{i // 52 + 1:03d}'})
+    for i in range(county_count)]
+    zctas = [(f'ZCTA5 {i:05d}', {'zip code tabulation area':f'{i:05d}'})
+    for i in range(1, zcta_count + 1)]
+    return {'state':states, 'county':counties, 'zip':zctas}
+
+
+def synthetic_variables(variable_count):
+    '''Returns a dictionary of synthetic variables in the format used by
+    variables.json.'''
+    variables = {}
+    for i in range(variable_count):
+        group = f'B{i // 50 + 1:05d}'
+        variables[f'{group}_{i % 50 + 1:03d}E'] = {
+            'label':f'Estimate!!Total:!!Category {i % 50 + 1}',
+            'concept':f'SYNTHETIC CONCEPT {i // 50 + 1}', 'group':group}
+    return variables
+
+
+class FakeCensusHandler(BaseHTTPRequestHandler):
+    '''Responds to Census API URLs using either recorded responses (see
+    --replay-dir) or synthetic data.'''
+
+    protocol_version = 'HTTP/1.1' # Allows keep-alive connections
+    geographies = None
+    variables = None
+    recorded_responses = {} # Maps keyless URLs to response bodies
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, body, content_type = 'application/json'):
+        encoded_body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(encoded_body)))
+        self.end_headers()
+        self.wfile.write(encoded_body)
+
+    def do_GET(self):
+        url = census_query._remove_api_key(
+            census_query._census_api_root + self.path)
+        if url in self.recorded_responses:
+            return self.send_body(self.recorded_responses[url])
+
+        url_parts = urlsplit(self.path)
+        if url_parts.path.endswith('variables.json'):
+            return self.send_body(json.dumps({'variables':self.variables}))
+        if url_parts.path.endswith('variables.html'):
+            rows = ''.join(f'<tr><td>{name}</td><td>{info["label"]}</td>'
+            f'<td>{info["concept"]}</td><td>int</td><td>{info["group"]}</td>'
+            '</tr>' for name, info in self.variables.items())
+            return self.send_body('<html><body><table><tr><th>Name</th>'
+            '<th>Label</th><th>Concept</th><th>Required</th><th>Group</th>'
+            '</tr>'+rows+'</table></body></html>', 'text/html')
+
+        query = parse_qs(url_parts.query)
+        fields = query['get'][0].split(',')
+        for_clause = query['for'][0]
+        if for_clause.startswith('zip'):
+            region = 'zip'
+        else:
+            region = for_clause.split(':')[0]
+        geographies = self.geographies[region]
+        id_columns = list(geographies[0][1])
+        # Values are random but reproducible for a given URL.
+        rng = random.Random(self.path)
+        rows = [fields + id_columns]
+        for name, ids in geographies:
+            rows.append([name if field == 'NAME' else
+            str(rng.randint(0, 100000)) for field in fields] +
+            list(ids.values()))
+        self.send_body(json.dumps(rows))
+
+
+def load_recorded_responses(replay_dir):
+    '''Loads the responses stored in a census_query ResponseCache folder
+    (see census_query.enable_response_cache) so that they can be replayed
+    by the fake server.'''
+    recorded_responses = {}
+    for file_name in os.listdir(replay_dir):
+        if not file_name.endswith('.meta.json'):
+            continue
+        meta_path = os.path.join(replay_dir, file_name)
+        with open(meta_path, encoding = 'utf-8') as f:
+            url = json.load(f)['url']
+        body_path = os.path.join(
+            replay_dir, file_name[:-len('.meta.json')] + '.body')
+        with open(body_path, encoding = 'utf-8') as f:
+            recorded_responses[url] = f.read()
+    return recorded_responses
+
+
+def serve(port, zcta_count, county_count, variable_count, replay_dir, ready):
+    FakeCensusHandler.geographies = synthetic_geographies(
+        zcta_count, county_count)
+    FakeCensusHandler.variables = synthetic_variables(variable_count)
+    if replay_dir is not None:
+        FakeCensusHandler.recorded_responses = load_recorded_responses(
+            replay_dir)
+    server = ThreadingHTTPServer(('127.0.0.1', port), FakeCensusHandler)
+    ready.set()
+    server.serve_forever()
+
+
+def start_fake_server(port, zcta_count, county_count, variable_count,
+replay_dir = None):
+    '''Starts the fake server in a separate process (so that its memory use
+    doesn't affect the benchmark's measurements) and returns the process.'''
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(target = serve, args = (port,
+    zcta_count, county_count, variable_count, replay_dir, ready),
+    daemon = True)
+    process.start()
+    ready.wait()
+    return process
+
+
+# Benchmark
+
+def measure(function, trace_memory = False):
+    '''Calls function and returns a dictionary containing its total runtime
+    and the time spent within each stage (as reported by census_query's
+    instrumentation). When several workers are used, stage times are 
+    summed across workers and may exceed the total.
+
+    trace_memory: if True, the function's peak memory use (as reported by
+    tracemalloc) will be measured instead. tracemalloc slows down 
+    allocation-heavy code considerably, so timings from these runs aren't
+    reported.'''
+    if trace_memory:
+        tracemalloc.start()
+    start_time = time.perf_counter()
+    try:
+        with census_query.collect_instrumentation() as events:
+            function()
+    finally:
+        total_time = time.perf_counter() - start_time
+        if trace_memory:
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    if trace_memory:
+        return {'peak_memory_mb':peak_memory / 1024**2}
+    df_summary = census_query.summarize_instrumentation(events)
+    result = {'total_seconds':total_time}
+    for stage in stages:
+        result[stage+'_seconds'] = float(df_summary['total_seconds'].get(
+            stage, 0.0))
+    result['bytes_downloaded'] = float(df_summary['bytes'].get(
+        'request', 0.0))
+    return result
+
+
+def run_benchmarks(args):
+    variables = list(synthetic_variables(args.variables))
+    df_variable_list = pd.DataFrame({'Variable':variables,
+    'Description':variables})
+    cases = {
+        'retrieve_census_data (zip)': lambda:
+            census_query.retrieve_census_data(df_variable_list, 2021, 'acs5',
+            'zip', 'benchmark', max_workers = args.max_workers),
+        'retrieve_census_data (county)': lambda:
+            census_query.retrieve_census_data(df_variable_list, 2021, 'acs5',
+            'county', 'benchmark', max_workers = args.max_workers),
+        'compare_variable_across_years (zip)': lambda:
+            census_query.compare_variable_across_years(variables[0],
+            'population', 'acs5', list(range(2021 - args.years + 1, 2022)),
+            'zip', 'benchmark', max_workers = args.max_workers),
+        'generate_variable_and_group_lists': lambda:
+            census_query.generate_variable_and_group_lists(
+                2021, 'acs5', 'Estimate'),
+    }
+
+    results = {}
+    for case_name, case in cases.items():
+        if args.only and args.only not in case_name:
+            continue
+        runs = [measure(case) for _ in range(args.repeat)]
+        # The fastest run is reported, as it is the least affected by
+        # unrelated activity on the machine.
+        results[case_name] = min(runs, key = lambda run: run['total_seconds'])
+        if not args.skip_memory:
+            results[case_name].update(measure(case, trace_memory = True))
+    return results
+
+
+def print_results(results, baseline = None):
+    df_results = pd.DataFrame(results).T
+    if baseline is not None:
+        df_baseline = pd.DataFrame(baseline).T.reindex(df_results.index)
+        df_results['baseline_total_seconds'] = df_baseline['total_seconds']
+        df_results['speedup'] = df_baseline['total_seconds'] / \
+            df_results['total_seconds']
+    with pd.option_context('display.width', 200,
+    'display.max_columns', None, 'display.float_format', '{:.3f}'.format):
+        print(df_results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmarks census_query '
+    'against a local stand-in for the Census API.')
+    parser.add_argument('--zctas', type = int, default = 33000,
+    help = 'Number of synthetic zip code tabulation areas')
+    parser.add_argument('--counties', type = int, default = 3221,
+    help = 'Number of synthetic counties')
+    parser.add_argument('--variables', type = int, default = 90,
+    help = 'Number of variables to retrieve (45 per batch)')
+    parser.add_argument('--years', type = int, default = 3,
+    help = 'Number of years for compare_variable_across_years')
+    parser.add_argument('--max-workers', type = int, default = 1)
+    parser.add_argument('--repeat', type = int, default = 3)
+    parser.add_argument('--only', help = 'Only run benchmarks whose names '
+    'contain this text')
+    parser.add_argument('--skip-memory', action = 'store_true',
+    help = 'Skip the (slower) peak memory measurements')
+    parser.add_argument('--port', type = int, default = 8765)
+    parser.add_argument('--replay-dir', help = 'A census_query response '
+    'cache folder whose responses will be replayed by the fake server')
+    parser.add_argument('--output', help = 'Save results to this JSON file')
+    parser.add_argument('--compare', help = 'A results JSON file from an '
+    'earlier run to compare against')
+    args = parser.parse_args()
+
+    server_process = start_fake_server(args.port, args.zctas, args.counties,
+    args.variables, args.replay_dir)
+    census_query.configure_http_client(
+        base_url = 'http://127.0.0.1:'+str(args.port))
+    census_query.disable_response_cache()
+    try:
+        results = run_benchmarks(args)
+    finally:
+        server_process.terminate()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding = 'utf-8') as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w', encoding = 'utf-8') as f:
+            json.dump(results, f, indent = 2)
@@ -0,0 +1,130 @@
+# census_query_jobs:
+# Runs a set of census_query retrieval jobs described in a YAML or TOML
+# file (see census_query.run_census_jobs), so that many tables can be 
+# retrieved in one scheduled run rather than one notebook cell at a time.
+# Released under the MIT License
+
+# Example usage:
+# python census_query_jobs.py nightly_jobs.toml --max-workers 8
+# python census_query_jobs.py nightly_jobs.yaml --dry-run
+
+# Example job file (TOML):
+# api_key_env = "CENSUS_API_KEY" # The environment variable storing the key
+# output_dir = "outputs"
+# max_workers = 8
+# requests_per_second = 10
+# cache_dir = "census_cache" # Optional (see enable_response_cache)
+# checkpoint_dir = "census_checkpoints" # Optional
+#
+# [[jobs]]
+# name = "acs5_2021_county_results"
+# source = "acs5"
+# year = 2021
+# region = "county"
+# groups = ["B01001"]
+#
+# [[jobs]]
+# name = "acs5_county_pop_2019_to_2021"
+# source = "acs5"
+# years = [2019, 2020, 2021]
+# region = "county"
+# variables = {B01001_001E = "population"}
+# output = "acs5_county_pop_2019_to_2021.parquet"
+#
+# The same settings can be written in YAML, with 'jobs' as a list.
+
+import argparse
+import os
+
+import census_query
+
+try:
+    import tomllib # Available in Python 3.11 and later
+except ImportError:
+    tomllib = None
+
+try:
+    import yaml # Optional: only needed for YAML job files
+except ImportError:
+    yaml = None
+
+
+def load_job_file(path):
+    '''Reads a YAML (.yaml or .yml) or TOML (.toml) job file and returns 
+    its settings as a dictionary.'''
+    if path.endswith('.toml'):
+        if tomllib is None:
+            raise ImportError('Reading TOML job files requires Python 3.11 '
+            'or later.')
+        with open(path, 'rb') as f:
+            return tomllib.load(f)
+    if path.endswith(('.yaml', '.yml')):
+        if yaml is None:
+            raise ImportError('Reading YAML job files requires PyYAML '
+            '(pip install pyyaml).')
+        with open(path, encoding = 'utf-8') as f:
+            return yaml.safe_load(f)
+    raise ValueError('Job files must end in .toml, .yaml, or .yml.')
+
+
+def get_api_key(settings, api_key = None):
+    '''Returns the API key from the command line, the job file's 'api_key'
+    setting, or the environment variable named by its 'api_key_env' 
+    setting (CENSUS_API_KEY by default), in that order.'''
+    if api_key is not None:
+        return api_key
+    if 'api_key' in settings:
+        return settings['api_key']
+    api_key_env = settings.get('api_key_env', 'CENSUS_API_KEY')
+    if api_key_env not in os.environ:
+        raise ValueError('No API key was found. Provide one with --api-key,'
+        ' the job file\'s api_key setting, or the '+api_key_env+
+        ' environment variable.')
+    return os.environ[api_key_env]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Runs census_query '
+    'retrieval jobs described in a YAML or TOML file.')
+    parser.add_argument('job_file', help = 'A .toml, .yaml, or .yml file '
+    'listing the jobs to run')
+    parser.add_argument('--api-key', help = 'A Census API key (overrides '
+    'the job file)')
+    parser.add_argument('--output-dir', help = 'The folder in which output '
+    'tables will be saved (overrides the job file)')
+    parser.add_argument('--max-workers', type = int, help = 'The maximum '
+    'number of requests to run at the same time (overrides the job file)')
+    parser.add_argument('--requests-per-second', type = float, help = 'A '
+    'limit on requests per second (overrides the job file)')
+    parser.add_argument('--checkpoint-dir', help = 'A folder in which to '
+    'save progress so that failed runs can be resumed (overrides the job '
+    'file)')
+    parser.add_argument('--only', help = 'Only run jobs whose names contain '
+    'this text')
+    parser.add_argument('--dry-run', action = 'store_true', help = 'Plan '
+    'the requests without retrieving any data')
+    args = parser.parse_args()
+
+    settings = load_job_file(args.job_file)
+    jobs = settings['jobs']
+    if args.only:
+        jobs = [job for job in jobs if args.only in job['name']]
+
+    if settings.get('cache_dir'):
+        census_query.enable_response_cache(settings['cache_dir'])
+
+    def choose(argument, setting, default):
+        # Command-line arguments take precedence over the job file.
+        if argument is not None:
+            return argument
+        return settings.get(setting, default)
+
+    census_query.run_census_jobs(jobs, get_api_key(settings, args.api_key),
+    output_dir = choose(args.output_dir, 'output_dir', '.'),
+    max_workers = choose(args.max_workers, 'max_workers', 1),
+    requests_per_second = choose(args.requests_per_second, 
+    'requests_per_second', None),
+    checkpoint_dir = choose(args.checkpoint_dir, 'checkpoint_dir', None),
+    index_path = settings.get('index_path', 
+    census_query._default_variable_index_path),
+    dry_run = args.dry_run)
@@ -0,0 +1,606 @@
+# test_census_query:
+# Regression tests for census_query. These tests run offline against the
+# fake Census API from census_query_benchmark.
+# Released under the MIT License
+
+# Usage:
+# python -m pytest test_census_query.py
+
+import asyncio
+import gzip
+import json
+import os
+import threading
+import time
+import urllib.error
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from urllib.request import urlopen
+
+import pandas as pd
+import pytest
+
+import census_query
+from census_query_benchmark import (FakeCensusHandler,
+synthetic_geographies, synthetic_variables)
+
+
+# The last year in which the API's zip code responses contained a 'state'
+# column. (Later responses only identify each region by its zip code.)
+last_zip_state_year = 2016
+
+
+class StubCensusHandler(FakeCensusHandler):
+    '''A version of FakeCensusHandler whose zip code responses for
+    last_zip_state_year and earlier contain a 'state' column (and omit
+    some of the zip codes that appear in later years), as the real API's
+    responses do. Its other settings (see the fake_api fixture) simulate
+    errors and server behavior that census_query needs to handle.'''
+
+    old_zip_geographies = None
+    request_paths = [] # Every path requested since the last reset
+    failures_left = 0 # The number of upcoming requests that will fail with
+    # a 503 error
+    retry_after = None # The Retry-After header sent with these errors
+    error_variables = {} # Maps variable codes to the error status 
+    # returned for any request that includes them
+    gzip_responses = False
+    close_after_response = False # If True, each connection is closed 
+    # after its first response (without a 'Connection: close' header),
+    # as servers do with connections that have been idle for too long.
+
+    def send_body(self, body, content_type = 'application/json'):
+        if not self.gzip_responses:
+            return super().send_body(body, content_type)
+        encoded_body = gzip.compress(body.encode('utf-8'))
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(encoded_body)))
+        self.end_headers()
+        self.wfile.write(encoded_body)
+
+    def send_error_body(self, status, message, headers = None):
+        encoded_body = message.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(encoded_body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(encoded_body)
+
+    def do_GET(self):
+        type(self).request_paths.append(self.path)
+        if self.close_after_response:
+            self.close_connection = True
+        if type(self).failures_left > 0:
+            type(self).failures_left -= 1
+            return self.send_error_body(503, 'error: service unavailable',
+            {} if self.retry_after is None else 
+            {'Retry-After':str(self.retry_after)})
+        query = parse_qs(urlsplit(self.path).query)
+        for variable in query.get('get', [''])[0].split(','):
+            if variable in self.error_variables:
+                return self.send_error_body(self.error_variables[variable],
+                "error: unknown variable '"+variable+"'")
+
+        # (Each handler can serve several requests over one connection, so
+        # the geographies are chosen again for every request.)
+        self.geographies = type(self).geographies
+        year = int(self.path.split('/')[2])
+        if year <= last_zip_state_year:
+            self.geographies = dict(self.geographies,
+            zip = self.old_zip_geographies)
+        return super().do_GET()
+
+
+@pytest.fixture(scope = 'module')
+def fake_api_root():
+    geographies = synthetic_geographies(zcta_count = 300, county_count = 200)
+    StubCensusHandler.geographies = geographies
+    StubCensusHandler.variables = synthetic_variables(100)
+    # Every third zip code only appears in later years.
+    StubCensusHandler.old_zip_geographies = [(name, {
+        'state':f'{int(ids["zip code tabulation area"]) % 52 + 1:02d}',
+        'zip code tabulation area':ids['zip code tabulation area']})
+        for i, (name, ids) in enumerate(geographies['zip']) if i % 3 != 0]
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubCensusHandler)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    api_root = 'http://127.0.0.1:'+str(server.server_address[1])
+    census_query.configure_http_client(base_url = api_root)
+    census_query.disable_response_cache()
+    yield api_root
+    server.shutdown()
+    census_query.configure_http_client()
+
+
+@pytest.fixture
+def fake_api(fake_api_root):
+    '''Returns the fake API's handler class (whose settings can be changed
+    by each test) after resetting its settings and request log. The HTTP
+    clients and response cache are reset after each test.'''
+    stub_settings = {'failures_left':0, 'retry_after':None, 
+    'error_variables':{}, 'gzip_responses':False, 
+    'close_after_response':False}
+    for name, value in stub_settings.items():
+        setattr(StubCensusHandler, name, value)
+    StubCensusHandler.request_paths = []
+    StubCensusHandler.api_root = fake_api_root
+    yield StubCensusHandler
+    for name, value in stub_settings.items():
+        setattr(StubCensusHandler, name, value)
+    census_query.configure_http_client(base_url = fake_api_root)
+    census_query.configure_async_http_client()
+    census_query.disable_response_cache()
+
+
+def read_response(api_root, request_string):
+    '''Retrieves a fake API response without going through census_query,
+    then converts it into a DataFrame in the same way that the original
+    version of census_query did (after pd.read_json).'''
+    with urlopen(request_string.replace(
+        census_query._census_api_root, api_root)) as response:
+        rows = json.load(response)
+    return pd.DataFrame(rows[1:], columns = rows[0],
+    index = range(1, len(rows)))
+
+
+def state_request_string(variables, year = 2021):
+    return 'https://api.census.gov/data/'+str(year)+'/acs/acs5?get=NAME,'+\
+        ','.join(variables)+'&for=state:*&key=test'
+
+
+# The functions below reproduce the original versions of
+# retrieve_census_data and compare_variable_across_years, which combined
+# each batch (or year) using outer merges on 'NAME'.
+
+def merge_retrieve_census_data(api_root, df_variable_list, year, region):
+    region_string = census_query._get_region_string(region)
+    extra_columns = {}
+    for start_point in range(0, len(df_variable_list), 45):
+        request_string = 'https://api.census.gov/data/'+str(year)+\
+            '/acs/acs5?get=NAME,'+','.join(df_variable_list['Variable'].iloc[
+                start_point:start_point + 45])+region_string+'&key=test'
+        batch_request = read_response(api_root, request_string)
+        for column in ['state', 'county']:
+            if column in batch_request.columns:
+                if start_point == 0:
+                    extra_columns[column] = pd.DataFrame(
+                        batch_request[['NAME', column]])
+                batch_request.drop(column, axis = 1, inplace = True)
+        if 'zip code tabulation area' in batch_request.columns:
+            batch_request.drop(
+                'zip code tabulation area', axis = 1, inplace = True)
+        if start_point == 0:
+            df_region_data = batch_request
+        else:
+            df_region_data = df_region_data.merge(
+                batch_request, on = 'NAME', how = 'outer')
+
+    df_region_data.columns = ['NAME'] + list(df_variable_list['Description'])
+    df_region_data.insert(1, 'Year', year)
+    for column in ['county', 'state']:
+        if column in extra_columns:
+            df_region_data = df_region_data.merge(extra_columns[column],
+            on = 'NAME', how = 'outer')
+            df_region_data.insert(2, column, df_region_data.pop(column))
+    if region == 'zip':
+        df_region_data['NAME'] = df_region_data['NAME'].str.replace(
+            'ZCTA5 ','').str.zfill(5)
+    for column in df_region_data.columns[1:]:
+        df_region_data[column] = pd.to_numeric(df_region_data[column])
+    return df_region_data
+
+
+def merge_compare_variable_across_years(api_root, variable, variable_name,
+year_list, region):
+    region_string = census_query._get_region_string(region)
+    extra_columns = {}
+    for i, year in enumerate(year_list):
+        df_year = read_response(api_root, 'https://api.census.gov/data/'+
+        str(year)+'/acs/acs5?get=NAME,'+variable+region_string+'&key=test')
+        df_year.rename(columns={variable:str(
+            variable_name)+'_'+str(year)},inplace=True)
+        for column in ['state', 'county']:
+            if column in df_year.columns:
+                if i == 0:
+                    extra_columns[column] = pd.DataFrame(
+                        df_year[['NAME', column]])
+                df_year.drop(column, axis = 1, inplace = True)
+        if 'zip code tabulation area' in df_year.columns:
+            df_year.drop('zip code tabulation area', axis = 1, inplace = True)
+        if i == 0:
+            df_data_across_years = df_year
+        else:
+            df_data_across_years = df_data_across_years.merge(
+                df_year, on = 'NAME', how = 'outer')
+
+    for column in df_data_across_years.columns[1:]:
+        df_data_across_years[column] = pd.to_numeric(
+            df_data_across_years[column])
+    for column in ['county', 'state']:
+        if column in extra_columns:
+            df_data_across_years = df_data_across_years.merge(
+                extra_columns[column], on = 'NAME', how = 'outer')
+            df_data_across_years.insert(
+                1, column, df_data_across_years.pop(column))
+    if region == 'zip':
+        df_data_across_years['NAME'] = \
+            df_data_across_years['NAME'].str.replace('ZCTA5 ','').str.zfill(5)
+    return df_data_across_years
+
+
+def assert_same_values(df, df_expected):
+    '''Checks that two results contain the same columns and values. (Data
+    types aren't compared, as census_query now stores its results using
+    compact dtypes.)'''
+    assert list(df.columns) == list(df_expected.columns)
+    pd.testing.assert_frame_equal(df.astype(object).where(df.notna(), None),
+    df_expected.astype(object).where(df_expected.notna(), None),
+    check_dtype = False, check_index_type = False)
+
+
+@pytest.mark.parametrize('region', ['state', 'county', 'zip'])
+def test_retrieve_census_data_matches_merge_path(fake_api_root, region):
+    variables = list(synthetic_variables(100))
+    df_variable_list = pd.DataFrame({'Variable':variables,
+    'Description':['Description of '+variable for variable in variables]})
+    df_result = census_query.retrieve_census_data(
+        df_variable_list, 2021, 'acs5', region, 'test')
+    assert_same_values(df_result, merge_retrieve_census_data(
+        fake_api_root, df_variable_list, 2021, region))
+
+
+@pytest.mark.parametrize('region, year_list', [
+    ('state', [2019, 2020, 2021]), ('county', [2019, 2020, 2021]),
+    ('zip', [2019, 2020, 2021]), ('zip', [2015, 2016]),
+    ('zip', [2011, 2016, 2021])])
+def test_compare_variable_across_years_matches_merge_path(fake_api_root,
+region, year_list):
+    variable = list(synthetic_variables(1))[0]
+    df_result = census_query.compare_variable_across_years(
+        variable, 'population', 'acs5', year_list, region, 'test')
+    df_expected = merge_compare_variable_across_years(
+        fake_api_root, variable, 'population', year_list, region)
+    # Percentage changes are compared separately, since the original
+    # version computed them before merging in the 'state' column.
+    change_columns = [column for column in df_result.columns
+    if column.endswith('_chg')]
+    assert_same_values(df_result.drop(columns = change_columns), df_expected)
+
+
+def test_mixed_vintage_zip_codes_are_keyed_by_zip_code(fake_api_root):
+    # Zip codes that appear in 2016 and 2021 should be combined into one
+    # row (with the 'state' column filled in from 2016), and zip codes
+    # that only appear in 2021 should have missing states.
+    variable = list(synthetic_variables(1))[0]
+    df_result = census_query.compare_variable_across_years(
+        variable, 'population', 'acs5', [2016, 2021], 'zip', 'test')
+    assert df_result['NAME'].is_unique
+    assert len(df_result) == 300
+    both_years = df_result['population_2016'].notna()
+    assert df_result.loc[both_years, 'state'].notna().all()
+    assert df_result.loc[~both_years, 'state'].isna().all()
+    assert df_result['2016_to_2021_population_chg'].notna().sum() == \
+        both_years.sum()
+
+
+def test_mixed_vintage_zip_panel_is_keyed_by_zip_code(fake_api_root):
+    variables = list(synthetic_variables(3))
+    df_panel = census_query.retrieve_census_panel(
+        variables, [2016, 2021], 'acs5', 'zip', 'test')
+    assert list(df_panel.columns) == ['NAME', 'state'] + variables
+    assert len(df_panel) == 200 + 300
+    assert (df_panel.index.get_level_values('GEOID') == 
+    df_panel['NAME']).all()
+
+
+
+@pytest.mark.parametrize('year', [2015, 2021])
+def test_zip_geography_index_is_keyed_by_zip_code(fake_api_root, year):
+    df_geographies = census_query.build_geography_index(
+        year, 'acs5', 'zip', 'test')
+    assert df_geographies.index.is_unique
+    assert (df_geographies['GEOID_string'] == df_geographies['NAME']).all()
+    assert ('state' in df_geographies.columns) == (
+        year <= last_zip_state_year)
+
+
+# Invalid variables
+
+def variables_with_invalid_codes():
+    variables = list(synthetic_variables(99))
+    for position, code in [(10, 'BAD_1E'), (50, 'BAD_2E'), (95, 'BAD_3E')]:
+        variables.insert(position, code)
+    return variables
+
+
+def test_find_invalid_variables_bisects_failed_batches(fake_api):
+    fake_api.error_variables = {'BAD_1E':400, 'BAD_2E':400, 'BAD_3E':404}
+    df_invalid = census_query.find_invalid_variables(
+        variables_with_invalid_codes(), 2021, 'acs5', 'state', 'test')
+    assert list(df_invalid['Variable']) == ['BAD_1E', 'BAD_2E', 'BAD_3E']
+    assert df_invalid['Error'].iloc[0] == ("HTTP Error 400: Bad Request "
+    "(error: unknown variable 'BAD_1E')")
+    # Testing each of the 102 variables on its own would take 102 
+    # requests.
+    assert len(fake_api.request_paths) <= 25
+
+
+def test_find_invalid_variables_raises_server_errors(fake_api):
+    # A server error says nothing about whether the variables are valid.
+    census_query.configure_http_client(base_url = fake_api.api_root,
+    max_retries = 0)
+    fake_api.failures_left = 100
+    with pytest.raises(urllib.error.HTTPError) as error:
+        census_query.find_invalid_variables(variables_with_invalid_codes(),
+        2021, 'acs5', 'state', 'test')
+    assert error.value.code == 503
+    assert len(fake_api.request_paths) == 1
+
+
+def test_retrieve_census_data_skips_invalid_variables(fake_api):
+    fake_api.error_variables = {'BAD_1E':400, 'BAD_2E':400, 'BAD_3E':400}
+    variables = variables_with_invalid_codes()
+    df_variable_list = pd.DataFrame({'Variable':variables,
+    'Description':variables})
+    df_result = census_query.retrieve_census_data(df_variable_list, 2021,
+    'acs5', 'county', 'test', skip_invalid_variables = True)
+    assert list(df_result.columns[4:]) == [variable for variable in 
+    variables if not variable.startswith('BAD')]
+    # The variables are checked using a single state's data, and only the
+    # valid variables are then requested for every county.
+    county_paths = [path for path in fake_api.request_paths 
+    if 'for=county' in path]
+    assert len(county_paths) == 3
+    assert all('for=state:01' in path for path in fake_api.request_paths 
+    if path not in county_paths)
+
+    with pytest.raises(ValueError):
+        census_query.retrieve_census_data(df_variable_list.iloc[[10, 50]],
+        2021, 'acs5', 'county', 'test', skip_invalid_variables = True)
+
+
+# Response cache
+
+def test_response_cache_ignores_api_keys(fake_api, tmp_path):
+    cache = census_query.enable_response_cache(str(tmp_path))
+    request_string = state_request_string(['B00001_001E'])
+    other_key_request_string = request_string.replace('key=test', 
+    'key=other')
+    assert census_query.ResponseCache.cache_key(request_string) == \
+        census_query.ResponseCache.cache_key(other_key_request_string)
+
+    df = census_query._read_census_json(request_string)
+    pd.testing.assert_frame_equal(
+        census_query._read_census_json(other_key_request_string), df)
+    assert len(fake_api.request_paths) == 1
+    with open(cache._paths(request_string)[1], encoding = 'utf-8') as f:
+        assert 'key=' not in json.load(f)['url']
+
+
+def test_response_cache_expires_responses(tmp_path):
+    cache = census_query.ResponseCache(str(tmp_path), ttl_seconds = 0.2)
+    cache.set('https://api.census.gov/data/a&key=test', 'body')
+    assert cache.get('https://api.census.gov/data/a&key=test') == 'body'
+    time.sleep(0.3)
+    assert cache.get('https://api.census.gov/data/a&key=test') is None
+
+
+def test_response_cache_evicts_least_recently_used_responses(tmp_path):
+    cache = census_query.ResponseCache(str(tmp_path), max_bytes = 250)
+    urls = {name:'https://api.census.gov/data/'+name for name in 'abc'}
+    cache.set(urls['a'], 'a' * 100)
+    cache.set(urls['b'], 'b' * 100)
+    # The files' modification times record when they were last used; 
+    # they're set explicitly here so that the order is unambiguous.
+    os.utime(cache._paths(urls['a'])[0], (1000, 1000))
+    os.utime(cache._paths(urls['b'])[0], (2000, 2000))
+    assert cache.get(urls['a']) == 'a' * 100 # 'b' is now the oldest
+    cache.set(urls['c'], 'c' * 100)
+    assert cache.get(urls['b']) is None
+    assert cache.get(urls['a']) == 'a' * 100
+    assert cache.get(urls['c']) == 'c' * 100
+
+
+def test_offline_response_cache_raises_on_misses(fake_api, tmp_path):
+    census_query.enable_response_cache(str(tmp_path))
+    cached_request_string = state_request_string(['B00001_001E'])
+    census_query._read_census_json(cached_request_string)
+
+    census_query.enable_response_cache(str(tmp_path), offline = True)
+    assert len(census_query._read_census_json(cached_request_string)) == 52
+    with pytest.raises(census_query.OfflineCacheMissError):
+        census_query._read_census_json(state_request_string(['B00001_002E']))
+    assert len(fake_api.request_paths) == 1
+
+
+# Checkpoints
+
+def test_checkpoint_resumes_failed_runs(fake_api, tmp_path):
+    census_query.configure_http_client(base_url = fake_api.api_root,
+    max_retries = 0)
+    variables = list(synthetic_variables(100)) # 3 batches
+    df_variable_list = pd.DataFrame({'Variable':variables,
+    'Description':variables})
+    checkpoint_dir = str(tmp_path / 'checkpoint')
+
+    # The second batch fails, so only the first one gets saved.
+    fake_api.error_variables = {variables[50]:503}
+    with pytest.raises(urllib.error.HTTPError):
+        census_query.retrieve_census_data(df_variable_list, 2021, 'acs5',
+        'county', 'test', checkpoint_dir = checkpoint_dir)
+    assert len(fake_api.request_paths) == 2
+
+    # Re-running the call only retrieves the two remaining batches.
+    fake_api.error_variables = {}
+    fake_api.request_paths.clear()
+    df_result = census_query.retrieve_census_data(df_variable_list, 2021,
+    'acs5', 'county', 'test', checkpoint_dir = checkpoint_dir)
+    assert len(fake_api.request_paths) == 2
+    pd.testing.assert_frame_equal(df_result, 
+    census_query.retrieve_census_data(df_variable_list, 2021, 'acs5', 
+    'county', 'test'))
+
+    # The folder can't be reused for a different set of requests.
+    with pytest.raises(ValueError, match = 'different request'):
+        census_query.retrieve_census_data(df_variable_list, 2020, 'acs5',
+        'county', 'test', checkpoint_dir = checkpoint_dir)
+
+
+# Progress messages
+
+def test_batch_progress_is_printed_as_batches_are_retrieved(fake_api, 
+capsys, tmp_path):
+    variables = list(synthetic_variables(100)) # 3 batches
+    df_variable_list = pd.DataFrame({'Variable':variables,
+    'Description':variables})
+    batches = census_query.stream_census_data(df_variable_list, 2021, 
+    'acs5', 'county', 'test')
+    assert 'Retrieving' not in capsys.readouterr().out
+    next(batches)
+    assert capsys.readouterr().out.splitlines()[-1] == (
+        'Retrieving data from rows 0 to 44')
+    list(batches)
+    assert capsys.readouterr().out.splitlines() == [
+        'Retrieving data from rows 45 to 89', 
+        'Retrieving data from rows 90 to 99']
+
+    # Dry runs don't retrieve any batches.
+    census_query.run_census_jobs([{'name':'jobs', 'source':'acs5', 
+    'year':2021, 'region':'county', 'variables':variables}], 'test', 
+    output_dir = str(tmp_path), dry_run = True)
+    assert 'Retrieving' not in capsys.readouterr().out
+    assert len(fake_api.request_paths) == 3
+
+
+# HTTP client
+
+def test_http_client_retries_server_errors(fake_api):
+    census_query.configure_http_client(base_url = fake_api.api_root,
+    backoff_factor = 0.01)
+    fake_api.failures_left = 2
+    df = census_query._read_census_json(state_request_string(['B00001_001E']))
+    assert len(df) == 52
+    assert len(fake_api.request_paths) == 3
+
+    # Errors that persist after every retry are raised.
+    census_query.configure_http_client(base_url = fake_api.api_root,
+    backoff_factor = 0.01, max_retries = 1)
+    fake_api.failures_left = 5
+    with pytest.raises(urllib.error.HTTPError) as error:
+        census_query._read_census_json(state_request_string(['B00001_001E']))
+    assert error.value.code == 503
+    assert len(fake_api.request_paths) == 5
+
+
+def test_http_client_honors_retry_after(fake_api):
+    census_query.configure_http_client(base_url = fake_api.api_root,
+    backoff_factor = 0.01)
+    fake_api.failures_left = 1
+    fake_api.retry_after = 1
+    start_time = time.perf_counter()
+    census_query._read_census_json(state_request_string(['B00001_001E']))
+    assert time.perf_counter() - start_time >= 1
+    # Retry-After delays are still capped at max_backoff.
+    client = census_query.CensusHTTPClient(max_backoff = 2)
+    assert client._retry_delay(0, '60') <= 2
+
+
+def test_http_client_decompresses_gzip_responses(fake_api):
+    request_string = state_request_string(['B00001_001E', 'B00001_002E'])
+    df_expected = census_query._read_census_json(request_string)
+    fake_api.gzip_responses = True
+    body, headers = census_query._http_client.get_bytes(request_string)
+    assert headers['Content-Encoding'] == 'gzip'
+    pd.testing.assert_frame_equal(
+        census_query._read_census_json(request_string), df_expected)
+
+
+def test_http_client_replaces_closed_idle_connections(fake_api):
+    # Every pooled connection is closed by the server after one response,
+    # so each request after the first finds dead connections in the pool.
+    # These shouldn't count as retries (of which none are allowed here).
+    census_query.configure_http_client(base_url = fake_api.api_root,
+    max_retries = 0)
+    fake_api.close_after_response = True
+    variables = list(synthetic_variables(100))
+    df_variable_list = pd.DataFrame({'Variable':variables,
+    'Description':variables})
+    for _ in range(2):
+        census_query.retrieve_census_data(df_variable_list, 2021, 'acs5',
+        'state', 'test', max_workers = 8)
+        time.sleep(0.2)
+        df = census_query._read_census_json(
+            state_request_string(['B00001_001E']))
+        assert len(df) == 52
+
+
+def test_http_errors_include_the_api_explanation(fake_api):
+    fake_api.error_variables = {'BAD_1E':400}
+    with pytest.raises(urllib.error.HTTPError) as error:
+        census_query._read_census_json(
+            state_request_string(['B00001_001E', 'BAD_1E']))
+    assert error.value.code == 400
+    assert error.value.read() == b"error: unknown variable 'BAD_1E'"
+
+
+# Async HTTP client
+
+def test_async_client_replaces_closed_idle_connections(fake_api):
+    census_query.configure_async_http_client(base_url = fake_api.api_root,
+    max_retries = 0)
+    fake_api.close_after_response = True
+    variables = list(synthetic_variables(8))
+
+    async def retrieve():
+        await asyncio.gather(*[
+            census_query.retrieve_single_census_variable_async('state', 2021,
+            'acs5', variable, variable, 'test') for variable in variables])
+        await asyncio.sleep(0.2)
+        return await census_query.retrieve_single_census_variable_async(
+            'state', 2021, 'acs5', 'population', variables[0], 'test')
+
+    assert len(asyncio.run(retrieve())) == 52
+
+
+def test_async_client_retries_and_reports_errors(fake_api):
+    census_query.configure_async_http_client(base_url = fake_api.api_root,
+    backoff_factor = 0.01, max_retries = 2)
+    fake_api.failures_left = 2
+    df = asyncio.run(census_query.retrieve_single_census_variable_async(
+        'state', 2021, 'acs5', 'population', 'B00001_001E', 'test'))
+    assert len(df) == 52
+    assert len(fake_api.request_paths) == 3
+
+    fake_api.error_variables = {'BAD_1E':400}
+    with pytest.raises(urllib.error.HTTPError) as error:
+        asyncio.run(census_query.retrieve_single_census_variable_async(
+            'state', 2021, 'acs5', 'population', 'BAD_1E', 'test'))
+    assert error.value.code == 400
+    assert error.value.read() == b"error: unknown variable 'BAD_1E'"
+
+
+def test_async_client_releases_its_semaphore_between_retries(fake_api):
+    # With only one request allowed in flight, a request that is waiting
+    # one second to be retried shouldn't hold up a second request.
+    census_query.configure_async_http_client(base_url = fake_api.api_root,
+    max_concurrency = 1)
+    fake_api.failures_left = 1
+    fake_api.retry_after = 1
+
+    async def retrieve(variable):
+        await census_query.retrieve_single_census_variable_async(
+            'state', 2021, 'acs5', variable, variable, 'test')
+        return time.perf_counter() - start_time
+
+    async def retrieve_both():
+        return await asyncio.gather(retrieve('B00001_001E'),
+        retrieve('B00001_002E'))
+
+    start_time = time.perf_counter()
+    durations = sorted(asyncio.run(retrieve_both()))
+    assert durations[0] < 0.5
+    assert durations[1] >= 1